@@ -54,6 +54,29 @@ EOF
 cd ..
 sam build --template-file infrastructure/template.yaml
 
+# The users table lives outside the stack; API-key lookups need its ApiKeyIndex GSI
+USERS_TABLE="delta3-users-${ENVIRONMENT}"
+echo ""
+echo "🗂  Checking ApiKeyIndex on ${USERS_TABLE}..."
+if INDEXES=$(aws dynamodb describe-table \
+        --table-name ${USERS_TABLE} \
+        --region ${REGION} \
+        --query "Table.GlobalSecondaryIndexes[].IndexName" \
+        --output text 2>/dev/null); then
+    if ! echo "${INDEXES}" | grep -qw ApiKeyIndex; then
+        echo "   Creating ApiKeyIndex (API keys fall back to a table scan until it is ACTIVE)"
+        aws dynamodb update-table \
+            --table-name ${USERS_TABLE} \
+            --region ${REGION} \
+            --attribute-definitions AttributeName=api_key,AttributeType=S \
+            --global-secondary-index-updates \
+            '[{"Create":{"IndexName":"ApiKeyIndex","KeySchema":[{"AttributeName":"api_key","KeyType":"HASH"}],"Projection":{"ProjectionType":"ALL"}}}]' \
+            > /dev/null
+    fi
+else
+    echo "   ⚠️  ${USERS_TABLE} not found; create it with an ApiKeyIndex GSI on api_key (projection ALL)"
+fi
+
 # Deploy
 echo ""
 echo "🚀 Deploying to AWS..."
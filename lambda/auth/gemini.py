@@ -2,6 +2,7 @@
 Gemini AI integration for code execution.
 """
 
+import functools
 import json
 import subprocess
 import tempfile
@@ -109,6 +110,12 @@ When asked to write code:
 Always verify your work by checking outputs."""
 
 
+@functools.lru_cache(maxsize=128)
+def _get_genai_client(api_key: str) -> genai.Client:
+    """Gemini client per API key, reused across warm invocations."""
+    return genai.Client(api_key=api_key)
+
+
 class CodeExecutor:
     """Executes code in Lambda's /tmp directory."""
     
@@ -226,7 +233,7 @@ class GeminiAgent:
     """Gemini-powered coding agent."""
     
     def __init__(self, api_key: str):
-        self.client = genai.Client(api_key=api_key)
+        self.client = _get_genai_client(api_key)
         self.executor = CodeExecutor()
         self.history: List[types.Content] = []
     
@@ -3,62 +3,122 @@ Authentication Lambda handler.
 Handles user registration, login, and session management.
 """
 
-import json
+import hashlib
 import os
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import orjson
 
 import storage
 
+# Warm containers answer repeated lookups from memory for this many seconds
+SESSION_CACHE_TTL = 30
+USER_CACHE_TTL = 60
+CACHE_MAX_ENTRIES = 10000
+
+# Keyed by a hash of the session token so raw tokens are never kept around
+_SESSION_CACHE: Dict[str, Tuple[float, str]] = {}
+_USER_CACHE: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+
+
+def _token_key(session_token: str) -> str:
+    return hashlib.sha256(session_token.encode()).hexdigest()[:32]
+
+
+def _cache_get(cache: dict, key: str):
+    entry = cache.get(key)
+    if entry and entry[0] > time.monotonic():
+        return entry[1]
+    cache.pop(key, None)
+    return None
+
+
+def _cache_put(cache: dict, key: str, value, ttl: float):
+    if len(cache) >= CACHE_MAX_ENTRIES:
+        cache.pop(next(iter(cache)))
+    cache[key] = (time.monotonic() + ttl, value)
+
+
+def _cached_verify_session(session_token: str) -> Optional[str]:
+    """storage.verify_session with a short in-process cache."""
+    key = _token_key(session_token)
+    user_id = _cache_get(_SESSION_CACHE, key)
+    if user_id is None:
+        user_id = storage.verify_session(session_token)
+        if user_id:
+            _cache_put(_SESSION_CACHE, key, user_id, SESSION_CACHE_TTL)
+    return user_id
+
+
+def _cached_get_user(user_id: str) -> Optional[Dict[str, Any]]:
+    """storage.get_user with a short in-process cache."""
+    user = _cache_get(_USER_CACHE, user_id)
+    if user is None:
+        user = storage.get_user(user_id)
+        if user:
+            _cache_put(_USER_CACHE, user_id, user, USER_CACHE_TTL)
+    return user
+
+
+# Shared by every response; API Gateway only reads it
+_CORS_HEADERS = {
+    "Content-Type": "application/json",
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Headers": "Content-Type,Authorization,X-Session-Token",
+    "Access-Control-Allow-Methods": "GET,POST,PUT,DELETE,OPTIONS"
+}
+
 
 def response(status_code: int, body: dict, headers: dict = None) -> dict:
     """Create API Gateway response."""
-    default_headers = {
-        "Content-Type": "application/json",
-        "Access-Control-Allow-Origin": "*",
-        "Access-Control-Allow-Headers": "Content-Type,Authorization,X-Session-Token",
-        "Access-Control-Allow-Methods": "GET,POST,PUT,DELETE,OPTIONS"
-    }
-    if headers:
-        default_headers.update(headers)
-    
     return {
         "statusCode": status_code,
-        "headers": default_headers,
-        "body": json.dumps(body)
+        "headers": {**_CORS_HEADERS, **headers} if headers else _CORS_HEADERS,
+        "body": orjson.dumps(body).decode()
     }
 
 
+# Fixed envelopes on the hottest paths, serialized once per container
+_OPTIONS_OK = response(200, {"message": "OK"})
+_NOT_FOUND = response(404, {"error": "Not found"})
+
+
 def handler(event, context):
     """Main Lambda handler."""
     
     # Handle CORS preflight
     if event.get("httpMethod") == "OPTIONS":
-        return response(200, {"message": "OK"})
+        return _OPTIONS_OK
     
     path = event.get("path", "")
     method = event.get("httpMethod", "GET")
     
-    try:
-        body = json.loads(event.get("body") or "{}")
-    except json.JSONDecodeError:
-        return response(400, {"error": "Invalid JSON body"})
+    # Header names are case-insensitive; normalize them once per request
+    event["_headers_ci"] = {k.lower(): v for k, v in (event.get("headers") or {}).items()}
     
     # Route requests
-    if path == "/auth/register" and method == "POST":
-        return register(body)
+    route = _ROUTES.get((method, path))
+    if not route:
+        return _NOT_FOUND
     
-    elif path == "/auth/login" and method == "POST":
-        return login(body)
+    # Only routes that can carry a body pay for parsing one
+    body = {}
+    if method != "GET":
+        try:
+            body = orjson.loads(event.get("body") or "{}")
+        except orjson.JSONDecodeError:
+            return response(400, {"error": "Invalid JSON body"})
     
-    elif path == "/auth/logout" and method == "POST":
-        return logout(event)
-    
-    elif path == "/auth/me" and method == "GET":
-        return get_me(event)
-    
-    elif path == "/auth/gemini-key" and method == "POST":
-        return update_gemini_key(event, body)
-    
-    return response(404, {"error": "Not found"})
+    return route(event, body)
+
+
+# Registration checks in order; the first failing one is reported
+_REGISTER_CHECKS = (
+    (lambda email, password: email and password, "Email and password required"),
+    (lambda email, password: "@" in email, "Invalid email format"),
+    (lambda email, password: len(password) >= 6, "Password must be at least 6 characters"),
+)
 
 
 def register(body: dict):
@@ -66,14 +126,9 @@ def register(body: dict):
     email = body.get("email", "").strip().lower()
     password = body.get("password", "")
     
-    if not email or not password:
-        return response(400, {"error": "Email and password required"})
-    
-    if "@" not in email:
-        return response(400, {"error": "Invalid email format"})
-    
-    if len(password) < 6:
-        return response(400, {"error": "Password must be at least 6 characters"})
+    for check, error in _REGISTER_CHECKS:
+        if not check(email, password):
+            return response(400, {"error": error})
     
     try:
         result = storage.create_user(email, password)
@@ -114,23 +169,25 @@ def login(body: dict):
 def logout(event: dict):
     """Logout user (invalidate session)."""
     # For now, just return success - sessions expire naturally
+    session_token = event["_headers_ci"].get("x-session-token")
+    if session_token:
+        _SESSION_CACHE.pop(_token_key(session_token), None)
     return response(200, {"message": "Logged out"})
 
 
 def get_me(event: dict):
     """Get current user info."""
-    session_token = event.get("headers", {}).get("X-Session-Token") or \
-                    event.get("headers", {}).get("x-session-token")
+    session_token = event["_headers_ci"].get("x-session-token")
     
     if not session_token:
         return response(401, {"error": "Session token required"})
     
-    user_id = storage.verify_session(session_token)
+    user_id = _cached_verify_session(session_token)
     
     if not user_id:
         return response(401, {"error": "Invalid or expired session"})
     
-    user = storage.get_user(user_id)
+    user = _cached_get_user(user_id)
     
     if not user:
         return response(404, {"error": "User not found"})
@@ -146,13 +203,12 @@ def get_me(event: dict):
 
 def update_gemini_key(event: dict, body: dict):
     """Update user's Gemini API key."""
-    session_token = event.get("headers", {}).get("X-Session-Token") or \
-                    event.get("headers", {}).get("x-session-token")
+    session_token = event["_headers_ci"].get("x-session-token")
     
     if not session_token:
         return response(401, {"error": "Session token required"})
     
-    user_id = storage.verify_session(session_token)
+    user_id = _cached_verify_session(session_token)
     
     if not user_id:
         return response(401, {"error": "Invalid or expired session"})
@@ -166,6 +222,17 @@ def update_gemini_key(event: dict, body: dict):
         return response(400, {"error": "Invalid Gemini API key format"})
     
     if storage.update_gemini_key(user_id, gemini_key):
+        _USER_CACHE.pop(user_id, None)
         return response(200, {"message": "Gemini API key updated"})
     
     return response(500, {"error": "Failed to update API key"})
+
+
+# (method, path) -> handler taking (event, body)
+_ROUTES = {
+    ("POST", "/auth/register"): lambda event, body: register(body),
+    ("POST", "/auth/login"): lambda event, body: login(body),
+    ("POST", "/auth/logout"): lambda event, body: logout(event),
+    ("GET", "/auth/me"): lambda event, body: get_me(event),
+    ("POST", "/auth/gemini-key"): update_gemini_key,
+}
@@ -2,21 +2,81 @@
 Gemini AI integration for code execution with S3 persistence.
 """
 
+import base64
+import collections
+import functools
+import hashlib
+import io
 import json
 import subprocess
-import tempfile
+import threading
 import os
 import shutil
-from typing import Dict, Any, List, Optional
+import signal
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Union
 from google import genai
 from google.genai import types
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
+import storage
+
+# Parallel S3 transfers per container (the client pool must be at least as large)
+S3_TRANSFER_WORKERS = 32
+
 # S3 client
-s3 = boto3.client("s3", region_name=os.environ.get("AWS_REGION", "us-east-1"))
+s3 = boto3.client(
+    "s3",
+    region_name=os.environ.get("AWS_REGION", "us-east-1"),
+    config=Config(
+        max_pool_connections=50,
+        tcp_keepalive=True,
+        retries={"max_attempts": 3, "mode": "adaptive"},
+        s3={"addressing_style": "virtual"}
+    )
+)
 FILES_BUCKET = os.environ.get("FILES_BUCKET", "delta3-files")
 
+# Files above this size are transferred in parallel multipart chunks
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+_multipart_config = TransferConfig(multipart_threshold=MULTIPART_THRESHOLD, max_concurrency=10)
+
+# stdout/stderr beyond this are cut to their tail before reaching Gemini
+MAX_OUTPUT_CHARS = 8192
+
+# Once the context passes this many characters or turns, its older half is summarized
+HISTORY_MAX_CHARS = 60000
+HISTORY_MAX_TURNS = 60
+HISTORY_SUMMARY_CHARS = 2000
+
+# Formatted memory context is reused per user for this many seconds
+MEMORY_CACHE_TTL = 60
+_MEMORY_CONTEXT_CACHE: Dict[str, tuple] = {}
+_MEMORY_WRITE_TOOLS = {"store_memory", "update_memory", "delete_memory"}
+
+# Character budget for prior chat messages loaded into a new agent
+HISTORY_LOAD_CHARS = 20000
+
+# Stored chat roles mapped to Gemini content roles; anything else is not replayed
+_HISTORY_ROLES = {"user": "user", "assistant": "model"}
+
+# Scratch file execute_python writes each script to
+EXEC_SCRIPT_NAME = ".__exec.py"
+
+# Tool results echoed back to the client are cut to this many characters
+TOOL_PREVIEW_CHARS = 500
+
+# Shared across warm invocations so threads are not recreated per request
+_transfer_pool = ThreadPoolExecutor(max_workers=S3_TRANSFER_WORKERS)
+
+# user_id -> {relative path: S3 ETag} of files in /tmp known to match S3.
+# Survives warm invocations together with the /tmp workspace itself.
+_HYDRATED_USERS: Dict[str, Dict[str, str]] = {}
+
 # Tool definitions for Gemini
 TOOLS = [
     types.Tool(
@@ -248,6 +308,141 @@ CODING WORKFLOW:
 Always verify your work by checking outputs."""
 
 
+@functools.lru_cache(maxsize=1024)
+def _normalize_rel(path: str) -> str:
+    """Workspace-relative form of a tool-supplied path."""
+    rel = os.path.normpath(path.lstrip("/"))
+    if rel == ".":
+        return ""
+    parts = rel.split("/", 2)
+    # Absolute paths into the workspace (/tmp/workspace_<user>/...)
+    if parts[0] == "tmp" and len(parts) > 1 and parts[1].startswith("workspace"):
+        return parts[2] if len(parts) > 2 else ""
+    return rel
+
+
+def _content_chars(content: types.Content) -> int:
+    """Approximate size of a history entry in characters."""
+    total = 0
+    for part in content.parts or []:
+        if part.text:
+            total += len(part.text)
+        elif part.function_response:
+            total += len(str((part.function_response.response or {}).get("result", "")))
+        elif part.function_call:
+            total += len(str(part.function_call.args or ""))
+    return total
+
+
+def _summarize_contents(contents: List[types.Content]) -> str:
+    """One line per part of the given turns, clipped to HISTORY_SUMMARY_CHARS."""
+    lines = []
+    for content in contents:
+        for part in content.parts or []:
+            if part.text:
+                lines.append(f"{content.role}: {part.text[:500]}")
+            elif part.function_call:
+                lines.append(f"called {part.function_call.name}")
+            elif part.function_response:
+                lines.append(f"{part.function_response.name} returned")
+    summary = "\n".join(lines)
+    return summary[-HISTORY_SUMMARY_CHARS:]
+
+
+def invalidate_memory_context(user_id: str):
+    """Forget a user's cached memory context after their memories change."""
+    _MEMORY_CONTEXT_CACHE.pop(user_id, None)
+
+
+def _preview(text: str, limit: int = TOOL_PREVIEW_CHARS) -> str:
+    """Shorten text for display without leaving a dangling emoji modifier."""
+    if len(text) <= limit:
+        return text
+    cut = text[:limit]
+    # Drop a trailing base character whose variation selector or joiner got cut off
+    while cut and text[len(cut)] in "\ufe0f\u200d":
+        cut = cut[:-1]
+    return cut.rstrip("\u200d") + "…"
+
+
+def _merge_text_parts(parts: List[types.Part]) -> List[types.Part]:
+    """Join the consecutive text chunks of a streamed turn into single parts."""
+    merged = []
+    for part in parts:
+        if (part.text and not part.thought and merged and merged[-1].text
+                and not merged[-1].thought):
+            merged[-1] = types.Part(text=merged[-1].text + part.text)
+        else:
+            merged.append(part)
+    return merged
+
+
+def _drain_tail(stream, limit: int = MAX_OUTPUT_CHARS) -> str:
+    """Read a pipe to EOF, keeping and decoding only its last limit bytes."""
+    chunks = collections.deque()
+    kept = total = 0
+    for chunk in iter(lambda: stream.read1(65536), b""):
+        chunks.append(chunk)
+        kept += len(chunk)
+        total += len(chunk)
+        while kept - len(chunks[0]) >= limit:
+            kept -= len(chunks.popleft())
+    
+    data = b"".join(chunks)[-limit:].decode("utf-8", errors="replace")
+    if total > limit:
+        return f"...[{total - limit} bytes truncated]\n{data}"
+    return data
+
+
+def _kill_group(proc: subprocess.Popen):
+    """SIGKILL a child's whole process group, including anything it left running."""
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass  # Group already gone
+
+
+def _run_capped(args, timeout: float = 60, **kwargs) -> Dict[str, Any]:
+    """Like subprocess.run, but holding at most MAX_OUTPUT_CHARS of each stream.
+
+    The child gets its own process group, which is killed on timeout and
+    after exit so background processes can't hold the pipes open.
+    Raises subprocess.TimeoutExpired after killing the process.
+    """
+    proc = subprocess.Popen(
+        args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True, **kwargs
+    )
+    output = {}
+    streams = (("stdout", proc.stdout), ("stderr", proc.stderr))
+    readers = [
+        threading.Thread(target=lambda n=name, st=stream: output.__setitem__(n, _drain_tail(st)), daemon=True)
+        for name, stream in streams
+    ]
+    for reader in readers:
+        reader.start()
+    
+    try:
+        proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        _kill_group(proc)
+        proc.wait()
+        raise
+    finally:
+        _kill_group(proc)
+        for reader in readers:
+            reader.join(timeout=5)
+        # Closing a pipe under a live reader would block on its lock until EOF
+        for reader, (_, stream) in zip(readers, streams):
+            if not reader.is_alive():
+                stream.close()
+    
+    return {
+        "stdout": output.get("stdout", ""),
+        "stderr": output.get("stderr", ""),
+        "exit_code": proc.returncode
+    }
+
+
 class PersistentCodeExecutor:
     """Executes code with S3-backed persistent storage."""
     
@@ -255,98 +450,261 @@ class PersistentCodeExecutor:
         self.user_id = user_id
         self.workspace = f"/tmp/workspace_{user_id.replace('@', '_').replace('.', '_')}"
         self.s3_prefix = f"users/{user_id}/workspace/"
+        self._child_env = {**os.environ, "PYTHONPATH": self.workspace}
+        # path -> latest background upload of that path
+        self._uploads: Dict[str, Future] = {}
+        # path -> content written during the current model turn, not yet queued
+        self._write_buf: Dict[str, str] = {}
         self._setup_workspace()
     
     def _setup_workspace(self):
-        """Setup workspace by restoring files from S3."""
-        # Clean and create workspace
-        if os.path.exists(self.workspace):
-            shutil.rmtree(self.workspace)
+        """Setup workspace and index the user's files in S3.
+
+        Files are only downloaded when first needed (see _hydrate). On a
+        warm container, files left from an earlier invocation are kept
+        when their S3 ETag is unchanged; everything else is removed.
+        """
+        if not os.path.isdir(self.workspace):
+            _HYDRATED_USERS.pop(self.user_id, None)
         os.makedirs(self.workspace, exist_ok=True)
+        self._hydrated = _HYDRATED_USERS.setdefault(self.user_id, {})
         
-        # Restore files from S3
+        # relative path -> (S3 key, size, ETag) for every persisted file
+        self._s3_index: Dict[str, tuple] = {}
+        # Indexed files that have not been downloaded yet
+        self._pending = set()
+        # Set once code runs, since it may create files S3 does not know about
+        self._dirty = False
+        kept = set()
         try:
             paginator = s3.get_paginator('list_objects_v2')
             for page in paginator.paginate(Bucket=FILES_BUCKET, Prefix=self.s3_prefix):
                 for obj in page.get('Contents', []):
-                    key = obj['Key']
-                    relative_path = key.replace(self.s3_prefix, '')
-                    if relative_path:
-                        local_path = os.path.join(self.workspace, relative_path)
-                        os.makedirs(os.path.dirname(local_path), exist_ok=True)
-                        s3.download_file(FILES_BUCKET, key, local_path)
-        except ClientError:
-            pass  # No files yet, that's okay
+                    relative_path = obj['Key'].replace(self.s3_prefix, '')
+                    if not relative_path:
+                        continue
+                    local_path = os.path.join(self.workspace, relative_path)
+                    self._s3_index[relative_path] = (obj['Key'], obj.get('Size'), obj.get('ETag'))
+                    if self._hydrated.get(relative_path) == obj.get('ETag') and os.path.isfile(local_path):
+                        kept.add(relative_path)
+                    else:
+                        self._pending.add(relative_path)
+        except ClientError as e:
+            # A partial listing would make unlisted files look deleted; leave them
+            print(f"S3 list error: {e}")
+            return
+        
+        # Drop stale or unsynced leftovers so the workspace matches S3
+        for root, _, names in os.walk(self.workspace, topdown=False):
+            for name in names:
+                local_path = os.path.join(root, name)
+                if os.path.relpath(local_path, self.workspace) not in kept:
+                    os.unlink(local_path)
+            if root != self.workspace and not os.listdir(root):
+                os.rmdir(root)
+        for relative_path in list(self._hydrated):
+            if relative_path not in kept:
+                del self._hydrated[relative_path]
     
-    def _sync_to_s3(self, path: str, content: str = None):
-        """Sync a file to S3."""
-        # Normalize path
-        if path.startswith("/"):
-            path = path[1:]
-        if path.startswith("tmp/workspace"):
-            path = path.split("/", 3)[-1] if len(path.split("/")) > 3 else ""
+    def _mark_dirty(self):
+        """Note that code is about to run and may change any local file in place.
+
+        Its edits never reach S3, so no local copy can be trusted to match
+        its recorded ETag on the next warm start, and later uploads don't
+        record one either.
+        """
+        self._dirty = True
+        self._hydrated.clear()
+    
+    def refresh(self):
+        """Re-index a reused workspace against S3 (one listing plus ETag compare)."""
+        self.flush()
+        self._setup_workspace()
+    
+    def _hydrate(self, relative_paths: List[str] = None):
+        """Download indexed files (all of them by default) that are not local yet."""
+        if relative_paths is None:
+            relative_paths = list(self._pending)
+        
+        downloads = []
+        for relative_path in relative_paths:
+            if relative_path in self._pending:
+                local_path = os.path.join(self.workspace, relative_path)
+                if os.path.exists(local_path):
+                    self._pending.discard(relative_path)
+                else:
+                    downloads.append((relative_path, self._s3_index[relative_path]))
+        if not downloads:
+            return
         
+        # One makedirs per directory, not per file
+        for parent in {os.path.dirname(relative_path) for relative_path, _ in downloads}:
+            if parent:
+                os.makedirs(os.path.join(self.workspace, parent), exist_ok=True)
+        
+        def download(item):
+            relative_path, (key, size, etag) = item
+            local_path = os.path.join(self.workspace, relative_path)
+            try:
+                if size is None or size > MULTIPART_THRESHOLD:
+                    # Ranged GETs in parallel for large objects
+                    s3.download_file(FILES_BUCKET, key, local_path, Config=_multipart_config)
+                else:
+                    # The index already knows the size, so skip download_file's HEAD
+                    body = s3.get_object(Bucket=FILES_BUCKET, Key=key)["Body"].read()
+                    with open(local_path, "wb") as f:
+                        f.write(body)
+            except ClientError as e:
+                # Stay pending (without a partial copy) so the next access retries it
+                print(f"S3 restore error for {relative_path}: {e}")
+                if os.path.exists(local_path):
+                    os.remove(local_path)
+                return
+            self._pending.discard(relative_path)
+            self._hydrated[relative_path] = etag
+        
+        list(_transfer_pool.map(download, downloads))
+    
+    def _forget(self, path: str):
+        """Drop a path and anything under it from the S3 index."""
+        for index in (self._s3_index, self._hydrated):
+            for relative_path in list(index):
+                if relative_path == path or relative_path.startswith(f"{path}/"):
+                    del index[relative_path]
+                    self._pending.discard(relative_path)
+    
+    def _sync_to_s3(self, path: str, content: Union[str, bytes] = None):
+        """Sync a file to S3."""
+        path = _normalize_rel(path)
         s3_key = f"{self.s3_prefix}{path}"
         
+        if content is not None:
+            body = content.encode('utf-8') if isinstance(content, str) else content
+            digest = hashlib.md5(body).digest()
+            # Single-part ETags are the quoted MD5, so identical content needs no PUT
+            indexed = self._s3_index.get(path)
+            if indexed and indexed[2] == f'"{digest.hex()}"':
+                if not self._dirty:
+                    self._hydrated[path] = indexed[2]
+                self._pending.discard(path)
+                return
+        
+        self._hydrated.pop(path, None)
+        self._pending.discard(path)
         try:
             if content is not None:
-                s3.put_object(
-                    Bucket=FILES_BUCKET,
-                    Key=s3_key,
-                    Body=content.encode('utf-8'),
-                    ContentType='text/plain'
-                )
+                if len(body) > MULTIPART_THRESHOLD:
+                    s3.upload_fileobj(
+                        io.BytesIO(body), FILES_BUCKET, s3_key,
+                        ExtraArgs={"ContentType": "text/plain"},
+                        Config=_multipart_config
+                    )
+                    etag = None
+                else:
+                    etag = s3.put_object(
+                        Bucket=FILES_BUCKET,
+                        Key=s3_key,
+                        Body=body,
+                        ContentMD5=base64.b64encode(digest).decode(),
+                        ContentType='text/plain'
+                    ).get("ETag")
+                # The local copy now matches S3 and can be kept on warm starts,
+                # unless code has run and may have changed it since the write
+                if etag and not self._dirty:
+                    self._hydrated[path] = etag
+                self._s3_index[path] = (s3_key, len(body), etag)
             else:
                 # Read from local file
                 local_path = os.path.join(self.workspace, path)
                 if os.path.exists(local_path):
                     s3.upload_file(local_path, FILES_BUCKET, s3_key)
+                    self._s3_index[path] = (s3_key, os.path.getsize(local_path), None)
         except ClientError as e:
             print(f"S3 sync error: {e}")
     
+    def _queue_upload(self, path: str, content: str):
+        """Upload a written file in the background, after any earlier upload of it."""
+        previous = self._uploads.get(path)
+        
+        def upload():
+            if previous:
+                previous.result()
+            self._sync_to_s3(path, content)
+        
+        self._uploads[path] = _transfer_pool.submit(upload)
+    
+    def _wait_uploads(self, path: str = None):
+        """Wait for pending uploads of a path and anything under it (all by default)."""
+        for upload_path in list(self._uploads):
+            if path is None or upload_path == path or upload_path.startswith(f"{path}/"):
+                try:
+                    self._uploads.pop(upload_path).result()
+                except Exception as e:
+                    print(f"S3 sync error: {e}")
+    
+    def commit(self):
+        """Queue this turn's buffered writes; each path is uploaded once."""
+        write_buf, self._write_buf = self._write_buf, {}
+        for path, content in write_buf.items():
+            self._queue_upload(path, content)
+    
+    def flush(self):
+        """Block until every background upload has reached S3."""
+        self.commit()
+        self._wait_uploads()
+    
     def _delete_from_s3(self, path: str):
         """Delete a file from S3."""
-        if path.startswith("/"):
-            path = path[1:]
-        
-        s3_key = f"{self.s3_prefix}{path}"
+        s3_key = f"{self.s3_prefix}{_normalize_rel(path)}"
         
         try:
             s3.delete_object(Bucket=FILES_BUCKET, Key=s3_key)
         except ClientError:
             pass
     
+    def _delete_tree_from_s3(self, path: str):
+        """Delete every object under a directory from S3."""
+        prefix = f"{self.s3_prefix}{path.strip('/')}/"
+        
+        try:
+            keys = []
+            paginator = s3.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=FILES_BUCKET, Prefix=prefix):
+                keys.extend(obj['Key'] for obj in page.get('Contents', []))
+            self._delete_many_from_s3(keys)
+        except ClientError:
+            pass
+    
+    def _delete_many_from_s3(self, keys: List[str]):
+        """Delete S3 keys in batches of up to 1000 per request."""
+        for i in range(0, len(keys), 1000):
+            s3.delete_objects(
+                Bucket=FILES_BUCKET,
+                Delete={
+                    "Objects": [{"Key": key} for key in keys[i:i + 1000]],
+                    "Quiet": True
+                }
+            )
+    
     def execute_python(self, code: str) -> Dict[str, Any]:
         """Execute Python code."""
+        self._hydrate()
+        self._mark_dirty()
         try:
-            # Write to temp file
-            with tempfile.NamedTemporaryFile(
-                mode="w", 
-                suffix=".py", 
-                dir=self.workspace,
-                delete=False
-            ) as f:
+            # Overwrite one fixed script instead of creating a temp file per run
+            script_path = os.path.join(self.workspace, EXEC_SCRIPT_NAME)
+            with open(script_path, "w") as f:
                 f.write(code)
-                script_path = f.name
             
             # Execute
-            result = subprocess.run(
+            result = _run_capped(
                 ["python3", script_path],
-                capture_output=True,
-                text=True,
                 timeout=60,
                 cwd=self.workspace,
-                env={**os.environ, "PYTHONPATH": self.workspace}
+                env=self._child_env
             )
             
-            # Cleanup temp script
-            os.unlink(script_path)
-            
-            return {
-                "stdout": result.stdout,
-                "stderr": result.stderr,
-                "exit_code": result.returncode
-            }
+            return result
         except subprocess.TimeoutExpired:
             return {"stdout": "", "stderr": "Execution timed out (60s limit)", "exit_code": -1}
         except Exception as e:
@@ -354,21 +712,15 @@ class PersistentCodeExecutor:
     
     def execute_shell(self, command: str) -> Dict[str, Any]:
         """Execute shell command."""
+        self._hydrate()
+        self._mark_dirty()
         try:
-            result = subprocess.run(
+            return _run_capped(
                 command,
                 shell=True,
-                capture_output=True,
-                text=True,
                 timeout=60,
                 cwd=self.workspace
             )
-            
-            return {
-                "stdout": result.stdout,
-                "stderr": result.stderr,
-                "exit_code": result.returncode
-            }
         except subprocess.TimeoutExpired:
             return {"stdout": "", "stderr": "Command timed out (60s limit)", "exit_code": -1}
         except Exception as e:
@@ -378,15 +730,21 @@ class PersistentCodeExecutor:
         """Write file to workspace and sync to S3."""
         try:
             # Normalize path
-            clean_path = path.lstrip("/")
+            clean_path = _normalize_rel(path)
             full_path = os.path.join(self.workspace, clean_path)
-            os.makedirs(os.path.dirname(full_path) if os.path.dirname(full_path) else self.workspace, exist_ok=True)
-            
-            with open(full_path, "w") as f:
+            try:
+                f = open(full_path, "w")
+            except FileNotFoundError:
+                # Only create parent directories when they are actually missing
+                os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                f = open(full_path, "w")
+            with f:
                 f.write(content)
+            self._pending.discard(clean_path)
+            self._s3_index.setdefault(clean_path, (f"{self.s3_prefix}{clean_path}", len(content), None))
             
-            # Sync to S3 for persistence
-            self._sync_to_s3(clean_path, content)
+            # Synced to S3 by commit() at the end of the model turn
+            self._write_buf[clean_path] = content
             
             return {"success": True, "path": clean_path}
         except Exception as e:
@@ -395,8 +753,9 @@ class PersistentCodeExecutor:
     def read_file(self, path: str) -> Dict[str, Any]:
         """Read file from workspace."""
         try:
-            clean_path = path.lstrip("/")
+            clean_path = _normalize_rel(path)
             full_path = os.path.join(self.workspace, clean_path)
+            self._hydrate([clean_path])
             
             with open(full_path, "r") as f:
                 content = f.read()
@@ -408,123 +767,162 @@ class PersistentCodeExecutor:
             return {"success": False, "error": str(e)}
     
     def list_files(self, path: str = "") -> Dict[str, Any]:
-        """List files in directory."""
+        """List files in directory.
+
+        Until code has run, the workspace is exactly what the S3 index
+        describes, so the listing comes from the index alone.
+        """
         try:
-            clean_path = path.lstrip("/") if path else ""
+            clean_path = _normalize_rel(path) if path else ""
             full_path = os.path.join(self.workspace, clean_path) if clean_path else self.workspace
             
-            if not os.path.exists(full_path):
-                return {"success": True, "files": []}
+            files = {}
+            if self._dirty and os.path.isdir(full_path):
+                for name in os.listdir(full_path):
+                    item_path = os.path.join(full_path, name)
+                    # Skip the scratch script
+                    if name == EXEC_SCRIPT_NAME:
+                        continue
+                    files[name] = {
+                        "name": name,
+                        "type": "directory" if os.path.isdir(item_path) else "file",
+                        "size": os.path.getsize(item_path) if os.path.isfile(item_path) else None
+                    }
             
-            files = []
-            for name in os.listdir(full_path):
-                item_path = os.path.join(full_path, name)
-                # Skip temp files
-                if name.startswith("tmp") and name.endswith(".py"):
+            # Indexed files are listed without downloading them
+            prefix = f"{clean_path.rstrip('/')}/" if clean_path else ""
+            for relative_path, (_, size, _) in self._s3_index.items():
+                if not relative_path.startswith(prefix):
                     continue
-                files.append({
-                    "name": name,
-                    "type": "directory" if os.path.isdir(item_path) else "file",
-                    "size": os.path.getsize(item_path) if os.path.isfile(item_path) else None
-                })
+                name, _, rest = relative_path[len(prefix):].partition("/")
+                if name not in files:
+                    files[name] = {
+                        "name": name,
+                        "type": "directory" if rest else "file",
+                        "size": None if rest else size
+                    }
             
-            return {"success": True, "files": files}
+            return {"success": True, "files": list(files.values())}
         except Exception as e:
             return {"success": False, "error": str(e)}
     
     def delete_file(self, path: str) -> Dict[str, Any]:
         """Delete file from workspace and S3."""
         try:
-            clean_path = path.lstrip("/")
+            clean_path = _normalize_rel(path)
             full_path = os.path.join(self.workspace, clean_path)
+            # A queued upload landing after the delete would resurrect the file
+            self._wait_uploads(clean_path)
+            for buffered in list(self._write_buf):
+                if buffered == clean_path or buffered.startswith(f"{clean_path}/"):
+                    del self._write_buf[buffered]
             
+            is_dir = os.path.isdir(full_path) or any(
+                p.startswith(f"{clean_path}/") for p in self._s3_index
+            )
+            self._forget(clean_path)
             if os.path.exists(full_path):
-                if os.path.isdir(full_path):
+                if is_dir:
                     shutil.rmtree(full_path)
                 else:
                     os.unlink(full_path)
             
             # Delete from S3
-            self._delete_from_s3(clean_path)
+            if is_dir:
+                self._delete_tree_from_s3(clean_path)
+            else:
+                self._delete_from_s3(clean_path)
             
             return {"success": True, "path": clean_path}
         except Exception as e:
             return {"success": False, "error": str(e)}
 
 
+@functools.lru_cache(maxsize=32)
+def _generate_config(system_instruction: str) -> types.GenerateContentConfig:
+    """Build (once per distinct system prompt) the config sent with every call."""
+    return types.GenerateContentConfig(
+        tools=TOOLS,
+        system_instruction=system_instruction
+    )
+
+
+@functools.lru_cache(maxsize=128)
+def _get_genai_client(api_key: str) -> genai.Client:
+    """Gemini client per API key, reused across warm invocations."""
+    return genai.Client(api_key=api_key)
+
+
 class GeminiAgent:
     """Gemini-powered coding agent with persistent environment."""
     
     def __init__(self, api_key: str, user_id: str, chat_history: List[Dict] = None):
-        self.client = genai.Client(api_key=api_key)
+        self.client = _get_genai_client(api_key)
         self.user_id = user_id
         self.executor = PersistentCodeExecutor(user_id)
         self.history: List[types.Content] = []
+        self._tool_dispatch = {
+            "execute_python": self._tool_execute_python,
+            "execute_shell": self._tool_execute_shell,
+            "write_file": self._tool_write_file,
+            "read_file": self._tool_read_file,
+            "list_files": self._tool_list_files,
+            "delete_file": self._tool_delete_file,
+            "store_memory": self._tool_store_memory,
+            "search_memories": self._tool_search_memories,
+            "list_memories": self._tool_list_memories,
+            "update_memory": self._tool_update_memory,
+            "delete_memory": self._tool_delete_memory,
+        }
         
         # Load chat history into context
         if chat_history:
-            self._load_history(chat_history)
+            self.load_history(chat_history)
     
-    def _load_history(self, chat_history: List[Dict]):
+    def load_history(self, chat_history: List[Dict]):
         """Load previous chat history into Gemini context."""
-        # Only load recent messages to stay within context limits
-        recent = chat_history[-10:] if len(chat_history) > 10 else chat_history
-
-        for msg in recent:
-            role = msg.get("role", "user")
-            content = msg.get("content", "")
+        # Only load as many recent messages as fit the character budget
+        recent = []
+        budget = HISTORY_LOAD_CHARS
+        for msg in reversed(chat_history):
+            budget -= len(msg.get("content", ""))
+            if budget < 0 and recent:
+                break
+            recent.append(msg)
+        recent.reverse()
 
-            if role == "user":
-                self.history.append(types.Content(
-                    role="user",
-                    parts=[types.Part.from_text(text=content)]
-                ))
-            elif role == "assistant":
-                self.history.append(types.Content(
-                    role="model",
-                    parts=[types.Part.from_text(text=content)]
-                ))
+        self.history.extend(
+            types.Content(role=_HISTORY_ROLES[msg.get("role", "user")], parts=[types.Part(text=msg["content"])])
+            for msg in recent
+            if msg.get("content") and msg.get("role", "user") in _HISTORY_ROLES
+        )
 
     def _load_memories(self) -> str:
+        """Return the memory context, reusing one built in the last MEMORY_CACHE_TTL seconds."""
+        cached = _MEMORY_CONTEXT_CACHE.get(self.user_id)
+        if cached and time.monotonic() - cached[0] < MEMORY_CACHE_TTL:
+            return cached[1]
+        
+        try:
+            context = self._build_memory_context()
+        except Exception as e:
+            # Chat still works without memories; retry on the next message
+            print(f"Error loading memories: {e}")
+            return ""
+        _MEMORY_CONTEXT_CACHE[self.user_id] = (time.monotonic(), context)
+        return context
+    
+    def _build_memory_context(self) -> str:
         """Load relevant memories and format for context injection."""
-        import storage
-        from datetime import datetime, timedelta
 
-        memories = []
+        memories = storage.get_context_memories(self.user_id)
 
-        # Load critical memories (importance >= 9)
-        critical = storage.get_memories(
-            self.user_id,
-            min_importance=9,
-            limit=5
-        )
-        memories.extend(critical)
-
-        # Load recent important memories (last 7 days, importance >= 6)
-        recent = storage.get_memories(
-            self.user_id,
-            min_importance=6,
-            limit=10
-        )
-        # Filter to last 7 days
-        week_ago = (datetime.utcnow() - timedelta(days=7)).isoformat()
-        recent = [m for m in recent if m.get("created_at", "") >= week_ago]
-        memories.extend(recent)
-
-        # Deduplicate by memory_id
-        seen = set()
-        unique_memories = []
-        for mem in memories:
-            if mem["memory_id"] not in seen:
-                seen.add(mem["memory_id"])
-                unique_memories.append(mem)
-
-        if not unique_memories:
+        if not memories:
             return ""
 
         # Format memories by category
         by_category = {}
-        for mem in unique_memories:
+        for mem in memories:
             cat = mem.get("category", "other")
             if cat not in by_category:
                 by_category[cat] = []
@@ -545,139 +943,194 @@ class GeminiAgent:
     
     def execute_tool(self, name: str, args: Dict) -> str:
         """Execute a tool and return result as string."""
-        if name == "execute_python":
-            result = self.executor.execute_python(args["code"])
-            output = ""
-            if result["stdout"]:
-                output += f"Output:\n{result['stdout']}"
-            if result["stderr"]:
-                output += f"\nErrors:\n{result['stderr']}"
-            if not output:
-                output = f"Code executed (exit code: {result['exit_code']})"
-            return output
-        
-        elif name == "execute_shell":
-            result = self.executor.execute_shell(args["command"])
-            output = ""
-            if result["stdout"]:
-                output += result["stdout"]
-            if result["stderr"]:
-                output += f"\nErrors:\n{result['stderr']}"
-            if not output:
-                output = f"Command completed (exit code: {result['exit_code']})"
-            return output
-        
-        elif name == "write_file":
-            result = self.executor.write_file(args["path"], args["content"])
-            if result["success"]:
-                return f"✅ File saved: {result['path']} (persisted to storage)"
-            return f"❌ Error: {result['error']}"
-        
-        elif name == "read_file":
-            result = self.executor.read_file(args["path"])
-            if result["success"]:
-                return result["content"]
-            return f"❌ Error: {result['error']}"
-        
-        elif name == "list_files":
-            result = self.executor.list_files(args.get("path", ""))
-            if result["success"]:
-                if not result["files"]:
-                    return "📁 Directory is empty (no files yet)"
-                return "Files in workspace:\n" + "\n".join(
-                    f"{'📁' if f['type'] == 'directory' else '📄'} {f['name']}"
-                    + (f" ({f['size']} bytes)" if f.get('size') else "")
-                    for f in result["files"]
-                )
-            return f"❌ Error: {result['error']}"
-        
-        elif name == "delete_file":
-            result = self.executor.delete_file(args["path"])
-            if result["success"]:
-                return f"🗑️ Deleted: {result['path']}"
-            return f"❌ Error: {result['error']}"
-
-        elif name == "store_memory":
-            import storage
-            result = storage.save_memory(
-                self.user_id,
-                args["content"],
-                args["category"],
-                args["importance"],
-                args.get("tags", []),
-                source_context="Stored during conversation"
+        if name in _MEMORY_WRITE_TOOLS:
+            invalidate_memory_context(self.user_id)
+        handler = self._tool_dispatch.get(name)
+        if handler is None:
+            return f"Unknown tool: {name}"
+        return handler(args)
+
+    def _tool_execute_python(self, args: Dict) -> str:
+        result = self.executor.execute_python(args["code"])
+        output = ""
+        if result["stdout"]:
+            output += f"Output:\n{result['stdout']}"
+        if result["stderr"]:
+            output += f"\nErrors:\n{result['stderr']}"
+        if not output:
+            output = f"Code executed (exit code: {result['exit_code']})"
+        return output
+
+    def _tool_execute_shell(self, args: Dict) -> str:
+        result = self.executor.execute_shell(args["command"])
+        output = ""
+        if result["stdout"]:
+            output += result["stdout"]
+        if result["stderr"]:
+            output += f"\nErrors:\n{result['stderr']}"
+        if not output:
+            output = f"Command completed (exit code: {result['exit_code']})"
+        return output
+
+    def _tool_write_file(self, args: Dict) -> str:
+        result = self.executor.write_file(args["path"], args["content"])
+        if result["success"]:
+            return f"✅ File saved: {result['path']} (persisted to storage)"
+        return f"❌ Error: {result['error']}"
+
+    def _tool_read_file(self, args: Dict) -> str:
+        result = self.executor.read_file(args["path"])
+        if result["success"]:
+            return result["content"]
+        return f"❌ Error: {result['error']}"
+
+    def _tool_list_files(self, args: Dict) -> str:
+        result = self.executor.list_files(args.get("path", ""))
+        if result["success"]:
+            if not result["files"]:
+                return "📁 Directory is empty (no files yet)"
+            return "Files in workspace:\n" + "\n".join(
+                f"{'📁' if f['type'] == 'directory' else '📄'} {f['name']}"
+                + (f" ({f['size']} bytes)" if f.get('size') else "")
+                for f in result["files"]
             )
-            if result["success"]:
-                return f"✓ Memory stored (ID: {result['memory_id']})"
-            return f"Failed to store memory: {result.get('error', 'Unknown error')}"
+        return f"❌ Error: {result['error']}"
 
-        elif name == "search_memories":
-            import storage
-            query = args["query"]
-            category = args.get("category")
-            limit = args.get("limit", 5)
+    def _tool_delete_file(self, args: Dict) -> str:
+        result = self.executor.delete_file(args["path"])
+        if result["success"]:
+            return f"🗑️ Deleted: {result['path']}"
+        return f"❌ Error: {result['error']}"
 
-            memories = storage.search_memories(self.user_id, query, limit)
+    def _tool_store_memory(self, args: Dict) -> str:
+        result = storage.save_memory(
+            self.user_id,
+            args["content"],
+            args["category"],
+            args["importance"],
+            args.get("tags", []),
+            source_context="Stored during conversation"
+        )
+        if result["success"]:
+            return f"✓ Memory stored (ID: {result['memory_id']})"
+        return f"Failed to store memory: {result.get('error', 'Unknown error')}"
 
-            if not memories:
-                return "No matching memories found."
+    def _tool_search_memories(self, args: Dict) -> str:
+        memories = storage.search_memories(self.user_id, args["query"], args.get("limit", 5))
 
-            result = f"Found {len(memories)} memories:\n\n"
-            for mem in memories:
-                result += f"- [{mem['category']}] {mem['content']} (Importance: {mem['importance']}, ID: {mem['memory_id']})\n"
+        if not memories:
+            return "No matching memories found."
 
-            return result
+        result = f"Found {len(memories)} memories:\n\n"
+        for mem in memories:
+            result += f"- [{mem['category']}] {mem['content']} (Importance: {mem['importance']}, ID: {mem['memory_id']})\n"
 
-        elif name == "list_memories":
-            import storage
-            category = args.get("category")
-            limit = args.get("limit", 20)
+        return result
 
-            memories = storage.get_memories(self.user_id, category=category, limit=limit)
+    def _tool_list_memories(self, args: Dict) -> str:
+        category = args.get("category")
+        limit = args.get("limit", 20)
 
-            if not memories:
-                return "No memories found."
+        memories = storage.get_memories(self.user_id, category=category, limit=limit)
 
-            result = f"Your memories ({len(memories)} total):\n\n"
+        if not memories:
+            return "No memories found."
 
-            # Group by category
-            by_category = {}
-            for mem in memories:
-                cat = mem.get("category", "other")
-                if cat not in by_category:
-                    by_category[cat] = []
-                by_category[cat].append(mem)
+        result = f"Your memories ({len(memories)} total):\n\n"
 
-            for cat, mems in sorted(by_category.items()):
-                result += f"\n[{cat.upper()}]\n"
-                for mem in mems:
-                    result += f"  - {mem['content']} (Importance: {mem['importance']}, ID: {mem['memory_id']})\n"
+        # Group by category
+        by_category = {}
+        for mem in memories:
+            cat = mem.get("category", "other")
+            if cat not in by_category:
+                by_category[cat] = []
+            by_category[cat].append(mem)
 
-            return result
+        for cat, mems in sorted(by_category.items()):
+            result += f"\n[{cat.upper()}]\n"
+            for mem in mems:
+                result += f"  - {mem['content']} (Importance: {mem['importance']}, ID: {mem['memory_id']})\n"
 
-        elif name == "update_memory":
-            import storage
-            result = storage.update_memory(
-                self.user_id,
-                args["memory_id"],
-                args.get("new_content"),
-                args.get("importance")
-            )
-            if result["success"]:
-                return "✓ Memory updated"
-            return f"Failed to update memory: {result.get('error', 'Unknown error')}"
+        return result
 
-        elif name == "delete_memory":
-            import storage
-            success = storage.delete_memory(self.user_id, args["memory_id"])
-            if success:
-                return "✓ Memory deleted"
-            return "Failed to delete memory"
+    def _tool_update_memory(self, args: Dict) -> str:
+        result = storage.update_memory(
+            self.user_id,
+            args["memory_id"],
+            args.get("new_content"),
+            args.get("importance")
+        )
+        if result["success"]:
+            return "✓ Memory updated"
+        return f"Failed to update memory: {result.get('error', 'Unknown error')}"
 
-        return f"Unknown tool: {name}"
+    def _tool_delete_memory(self, args: Dict) -> str:
+        if storage.delete_memory(self.user_id, args["memory_id"]):
+            return "✓ Memory deleted"
+        return "Failed to delete memory"
     
     def process_message(self, user_message: str) -> Dict[str, Any]:
         """Process user message and return response with tool calls."""
+        try:
+            return self._process_message(user_message)
+        finally:
+            # Files must be durable in S3 before the invocation returns
+            self.executor.flush()
+    
+    def _compact_history(self):
+        """Replace the older half of an oversized or overlong context with a short summary.
+
+        The kept half starts on a model turn or a user text turn, so no
+        tool response is separated from the call that produced it.
+        """
+        if (len(self.history) <= HISTORY_MAX_TURNS
+                and sum(_content_chars(c) for c in self.history) <= HISTORY_MAX_CHARS):
+            return
+        
+        cut = next((
+            i for i in range(len(self.history) // 2, len(self.history))
+            if self.history[i].role == "model"
+            or any(p.text for p in self.history[i].parts or [])
+        ), None)
+        if not cut:
+            return
+        
+        summary = _summarize_contents(self.history[:cut])
+        self.history = [types.Content(
+            role="user",
+            parts=[types.Part.from_text(text=f"[earlier context summary:\n{summary}]")]
+        )] + self.history[cut:]
+    
+    def _stream_turn(self, config: types.GenerateContentConfig):
+        """Stream one model turn, starting each tool call as soon as it arrives.
+
+        Tools run one at a time on a single worker, in the order the model
+        issued them, so the executor never sees concurrent calls.
+        """
+        parts = []
+        calls = []
+        futures = []
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            stream = self.client.models.generate_content_stream(
+                model="gemini-2.0-flash",
+                contents=self.history,
+                config=config
+            )
+            for chunk in stream:
+                if not chunk.candidates or not chunk.candidates[0].content:
+                    continue
+                for part in chunk.candidates[0].content.parts or []:
+                    parts.append(part)
+                    if part.function_call:
+                        fc = part.function_call
+                        call = (fc.name, dict(fc.args) if fc.args else {})
+                        calls.append(call)
+                        futures.append(pool.submit(self.execute_tool, *call))
+            results = [future.result() for future in futures]
+        return _merge_text_parts(parts), calls, results
+    
+    def _process_message(self, user_message: str) -> Dict[str, Any]:
+        """Run the model/tool loop for one user message."""
         # Add user message to history
         self.history.append(types.Content(
             role="user",
@@ -693,59 +1146,46 @@ class GeminiAgent:
         enhanced_prompt = SYSTEM_PROMPT
         if memory_context:
             enhanced_prompt += f"\n\n{memory_context}"
+        config = _generate_config(enhanced_prompt)
 
         for _ in range(max_iterations):
-            # Generate response
+            self._compact_history()
+            
+            # Stream the response, running tools while it is still arriving
             try:
-                response = self.client.models.generate_content(
-                    model="gemini-2.0-flash",
-                    contents=self.history,
-                    config=types.GenerateContentConfig(
-                        tools=TOOLS,
-                        system_instruction=enhanced_prompt
-                    )
-                )
+                parts, calls, results = self._stream_turn(config)
             except Exception as e:
                 return {
                     "response": f"Error calling Gemini: {str(e)}",
                     "tool_calls": tool_calls
                 }
             
-            if not response.candidates or not response.candidates[0].content.parts:
+            if not parts:
                 return {
                     "response": final_text if final_text else "No response generated",
                     "tool_calls": tool_calls
                 }
             
             # Add to history
-            self.history.append(response.candidates[0].content)
+            self.history.append(types.Content(role="model", parts=parts))
             
-            # Process parts
-            has_tool_calls = False
+            text = "".join(part.text for part in parts if part.text)
+            if text:
+                final_text = text
+            has_tool_calls = bool(calls)
             tool_response_parts = []
             
-            for part in response.candidates[0].content.parts:
-                if part.function_call:
-                    has_tool_calls = True
-                    fc = part.function_call
-                    args = dict(fc.args) if fc.args else {}
-                    
-                    # Execute tool
-                    result = self.execute_tool(fc.name, args)
-                    
-                    tool_calls.append({
-                        "tool": fc.name,
-                        "args": args,
-                        "result": result[:500]  # Truncate for response
-                    })
-                    
-                    tool_response_parts.append(types.Part.from_function_response(
-                        name=fc.name,
-                        response={"result": result}
-                    ))
+            for (name, args), result in zip(calls, results):
+                tool_calls.append({
+                    "tool": name,
+                    "args": args,
+                    "result": _preview(result)
+                })
                 
-                elif part.text:
-                    final_text = part.text
+                tool_response_parts.append(types.Part.from_function_response(
+                    name=name,
+                    response={"result": result}
+                ))
             
             if not has_tool_calls:
                 return {
@@ -753,6 +1193,8 @@ class GeminiAgent:
                     "tool_calls": tool_calls
                 }
             
+            self.executor.commit()
+            
             # Send tool results back
             self.history.append(types.Content(
                 role="user",
@@ -3,36 +3,114 @@ Chat Lambda handler.
 Handles chat messages and code execution via Gemini.
 """
 
-import json
 import os
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from decimal import Decimal
 
+import orjson
+
 import storage
-from gemini import GeminiAgent
+from gemini import GeminiAgent, invalidate_memory_context
+
+# Overlaps independent storage calls within a request; reused across warm invocations
+_io_pool = ThreadPoolExecutor(max_workers=3)
+
+# Request size limits, in UTF-8 bytes
+MAX_MSG_BYTES = 64 * 1024
+MAX_FILE_BYTES = 1024 * 1024
+
+# Warm containers keep a user's agent (workspace index + Gemini context) for one burst of messages
+AGENT_CACHE_TTL = 60
+AGENT_CACHE_SIZE = 8
+
+# user_id -> (agent, gemini_key, monotonic deadline), least recently used first
+_AGENTS: "OrderedDict[str, tuple]" = OrderedDict()
+
+# Seconds a reply waits for its history write before Lambda may freeze the container
+HISTORY_SAVE_TIMEOUT = 2.0
+
+# History writes still running from an earlier request in this container
+_pending_saves = set()
+
+
+def _save_done(future):
+    """Forget a finished background history write, logging any failure."""
+    _pending_saves.discard(future)
+    if future.exception():
+        print(f"Chat history save failed: {future.exception()!r}")
+
+
+def _wait_for_saves():
+    """Let earlier background history writes land before history is read or cleared."""
+    for future in list(_pending_saves):
+        try:
+            future.result()
+        except Exception:
+            pass  # Already logged by _save_done
+
+
+def _get_agent(user_id: str, gemini_key: str) -> GeminiAgent:
+    """Reuse this user's agent from an earlier warm invocation, or build one with its history."""
+    entry = _AGENTS.pop(user_id, None)
+    if entry and entry[1] == gemini_key and entry[2] > time.monotonic():
+        agent = entry[0]
+        # Other containers or functions may have changed the user's files since
+        agent.executor.refresh()
+    else:
+        # Fetch chat history while the agent restores the workspace from S3
+        _wait_for_saves()
+        history_future = _io_pool.submit(storage.get_chat_history, user_id, 20)
+        agent = GeminiAgent(api_key=gemini_key, user_id=user_id)
+        agent.load_history(history_future.result())
+    _AGENTS[user_id] = (agent, gemini_key, time.monotonic() + AGENT_CACHE_TTL)
+    if len(_AGENTS) > AGENT_CACHE_SIZE:
+        _AGENTS.popitem(last=False)
+    return agent
+
+
+def _too_large(text: str, limit: int) -> bool:
+    """Check a string's UTF-8 size, encoding only when the length alone can't decide."""
+    if len(text) > limit:
+        return True
+    if len(text) * 4 <= limit:
+        return False
+    return len(text.encode("utf-8")) > limit
+
+
+def _json_default(obj):
+    """Handle Decimal types from DynamoDB."""
+    if isinstance(obj, Decimal):
+        return int(obj) if obj % 1 == 0 else float(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
 
 
-class DecimalEncoder(json.JSONEncoder):
-    """Handle Decimal types from DynamoDB."""
-    def default(self, obj):
-        if isinstance(obj, Decimal):
-            return int(obj) if obj % 1 == 0 else float(obj)
-        return super().default(obj)
+# Shared by every response; API Gateway only reads it
+_CORS_HEADERS = {
+    "Content-Type": "application/json",
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Headers": "Content-Type,Authorization,X-Session-Token,X-API-Key",
+    "Access-Control-Allow-Methods": "GET,POST,PUT,DELETE,OPTIONS"
+}
 
 
 def response(status_code: int, body: dict) -> dict:
     """Create API Gateway response."""
     return {
         "statusCode": status_code,
-        "headers": {
-            "Content-Type": "application/json",
-            "Access-Control-Allow-Origin": "*",
-            "Access-Control-Allow-Headers": "Content-Type,Authorization,X-Session-Token,X-API-Key",
-            "Access-Control-Allow-Methods": "GET,POST,PUT,DELETE,OPTIONS"
-        },
-        "body": json.dumps(body, cls=DecimalEncoder)
+        "headers": _CORS_HEADERS,
+        "body": orjson.dumps(body, default=_json_default).decode()
     }
 
 
+# Fixed envelopes on the hottest paths, serialized once per container
+_OPTIONS_OK = response(200, {"message": "OK"})
+_NOT_FOUND = response(404, {"error": "Not found"})
+_AUTH_REQUIRED = response(401, {"error": "Authentication required"})
+
+
 def get_user_from_request(event: dict) -> tuple:
     """Extract and verify user from request. Returns (user_id, gemini_key, error_response)."""
     headers = event.get("headers", {})
@@ -40,24 +118,24 @@ def get_user_from_request(event: dict) -> tuple:
     # Try session token first
     session_token = headers.get("X-Session-Token") or headers.get("x-session-token")
     if session_token:
-        user_id = storage.verify_session(session_token)
-        if user_id:
-            user = storage.get_user(user_id)
-            if user and user.get("gemini_key"):
-                return user_id, user["gemini_key"], None
+        auth = storage.authenticate(session_token=session_token)
+        if auth:
+            user_id, gemini_key = auth
+            if gemini_key:
+                return user_id, gemini_key, None
             return None, None, response(400, {"error": "Gemini API key not set. Please add it in settings."})
     
     # Try API key
     api_key = headers.get("X-API-Key") or headers.get("x-api-key")
     if api_key:
-        user_id = storage.verify_api_key(api_key)
-        if user_id:
-            user = storage.get_user(user_id)
-            if user and user.get("gemini_key"):
-                return user_id, user["gemini_key"], None
+        auth = storage.authenticate(api_key=api_key)
+        if auth:
+            user_id, gemini_key = auth
+            if gemini_key:
+                return user_id, gemini_key, None
             return None, None, response(400, {"error": "Gemini API key not set"})
     
-    return None, None, response(401, {"error": "Authentication required"})
+    return None, None, _AUTH_REQUIRED
 
 
 def handler(event, context):
@@ -65,90 +143,70 @@ def handler(event, context):
     
     # Handle CORS preflight
     if event.get("httpMethod") == "OPTIONS":
-        return response(200, {"message": "OK"})
+        return _OPTIONS_OK
     
     path = event.get("path", "")
     method = event.get("httpMethod", "GET")
     
-    try:
-        body = json.loads(event.get("body") or "{}")
-    except json.JSONDecodeError:
-        return response(400, {"error": "Invalid JSON body"})
-    
     # Route requests
-    if path == "/chat/send" and method == "POST":
-        return send_message(event, body)
-
-    elif path == "/chat/history" and method == "GET":
-        return get_history(event)
-
-    elif path == "/chat/clear" and method == "POST":
-        return clear_history(event)
-
-    elif path == "/files/list" and method == "GET":
-        return list_files(event)
-
-    elif path == "/files/read" and method == "POST":
-        return read_file(event, body)
-
-    elif path == "/files/write" and method == "POST":
-        return write_file(event, body)
-
-    elif path == "/files/delete" and method == "POST":
-        return delete_file(event, body)
-
-    elif path == "/memories" and method == "GET":
-        return get_memories(event)
-
-    elif path == "/memories" and method == "DELETE":
-        return delete_memory(event, body)
-
-    return response(404, {"error": "Not found"})
+    route = _ROUTES.get((method, path))
+    if not route:
+        return _NOT_FOUND
+    
+    # Only routes that can carry a body pay for parsing one
+    body = {}
+    if method != "GET":
+        try:
+            body = orjson.loads(event.get("body") or "{}")
+        except orjson.JSONDecodeError:
+            return response(400, {"error": "Invalid JSON body"})
+    
+    return route(event, body)
 
 
 def send_message(event: dict, body: dict):
     """Send message to Gemini and get response."""
-    user_id, gemini_key, error = get_user_from_request(event)
-    if error:
-        return error
-    
     message = body.get("message", "").strip()
     if not message:
         return response(400, {"error": "Message required"})
+    if _too_large(message, MAX_MSG_BYTES):
+        return response(413, {"error": f"Message exceeds {MAX_MSG_BYTES} bytes"})
+    
+    user_id, gemini_key, error = get_user_from_request(event)
+    if error:
+        return error
     
     try:
-        # Load chat history for context continuity
-        chat_history = storage.get_chat_history(user_id, limit=20)
-        
-        # Create agent with user's Gemini key, user_id, and history
-        # This will:
-        # 1. Restore user's files from S3 to /tmp workspace
-        # 2. Load previous chat context into Gemini
-        agent = GeminiAgent(
-            api_key=gemini_key,
-            user_id=user_id,
-            chat_history=chat_history
-        )
+        agent = _get_agent(user_id, gemini_key)
         
         # Process message (files created will auto-sync to S3)
         result = agent.process_message(message)
         
-        # Save to history for next session
-        storage.save_chat_message(user_id, "user", message)
-        storage.save_chat_message(
-            user_id, 
-            "assistant", 
-            result["response"],
-            tool_calls=result.get("tool_calls")
-        )
+        # Save to history for next session while the reply is serialized
+        save = _io_pool.submit(storage.save_chat_messages, user_id, [
+            {"role": "user", "content": message},
+            {"role": "assistant", "content": result["response"], "tool_calls": result.get("tool_calls")}
+        ])
+        _pending_saves.add(save)
+        save.add_done_callback(_save_done)
         
-        return response(200, {
+        reply = response(200, {
             "response": result["response"],
             "tool_calls": result.get("tool_calls", [])
         })
+        
+        # Lambda freezes the container on return, so the write must land first
+        try:
+            save.result(timeout=HISTORY_SAVE_TIMEOUT)
+        except FutureTimeoutError:
+            print(f"Chat history save still running after {HISTORY_SAVE_TIMEOUT}s for {user_id}")
+        except Exception:
+            pass  # Logged by _save_done
+        
+        return reply
     
     except Exception as e:
-        import traceback
+        _AGENTS.pop(user_id, None)
         return response(500, {"error": f"Chat error: {str(e)}", "trace": traceback.format_exc()})
 
 
@@ -162,6 +220,7 @@ def get_history(event: dict):
     params = event.get("queryStringParameters") or {}
     limit = int(params.get("limit", 50))
     
+    _wait_for_saves()
     history = storage.get_chat_history(user_id, limit=limit)
     
     return response(200, {"history": history})
@@ -173,6 +232,8 @@ def clear_history(event: dict):
     if error:
         return error
     
+    _AGENTS.pop(user_id, None)
+    _wait_for_saves()
     storage.clear_chat_history(user_id)
     
     return response(200, {"message": "History cleared"})
@@ -186,10 +247,14 @@ def list_files(event: dict):
     
     params = event.get("queryStringParameters") or {}
     path = params.get("path", "")
+    try:
+        limit = min(max(int(params.get("limit", 1000)), 1), 1000)
+    except ValueError:
+        return response(400, {"error": "limit must be an integer"})
     
-    files = storage.list_files(user_id, path)
+    listing = storage.list_files(user_id, path, limit=limit, continuation=params.get("next"))
     
-    return response(200, {"files": files, "path": path})
+    return response(200, {"files": listing["files"], "path": path, "next": listing["next"]})
 
 
 def read_file(event: dict, body: dict):
@@ -212,16 +277,19 @@ def read_file(event: dict, body: dict):
 
 def write_file(event: dict, body: dict):
     """Write a file."""
-    user_id, _, error = get_user_from_request(event)
-    if error:
-        return error
-    
     path = body.get("path", "")
     content = body.get("content", "")
     
     if not path:
         return response(400, {"error": "Path required"})
+    if _too_large(content, MAX_FILE_BYTES):
+        return response(413, {"error": f"File exceeds {MAX_FILE_BYTES} bytes"})
+    
+    user_id, _, error = get_user_from_request(event)
+    if error:
+        return error
     
+    _AGENTS.pop(user_id, None)
     if storage.write_file(user_id, path, content):
         return response(200, {"message": "File saved", "path": path})
     
@@ -238,6 +306,7 @@ def delete_file(event: dict, body: dict):
     if not path:
         return response(400, {"error": "Path required"})
 
+    _AGENTS.pop(user_id, None)
     if storage.delete_file(user_id, path):
         return response(200, {"message": "File deleted", "path": path})
 
@@ -260,7 +329,6 @@ def get_memories(event: dict):
 
         return response(200, {"memories": memories})
     except Exception as e:
-        import traceback
         return response(500, {"error": str(e), "trace": traceback.format_exc()})
 
 
@@ -276,5 +344,20 @@ def delete_memory(event: dict, body: dict):
         return response(400, {"error": "memory_id required"})
 
     success = storage.delete_memory(user_id, memory_id)
+    invalidate_memory_context(user_id)
 
     return response(200, {"success": success})
+
+
+# (method, path) -> handler taking (event, body)
+_ROUTES = {
+    ("POST", "/chat/send"): send_message,
+    ("GET", "/chat/history"): lambda event, body: get_history(event),
+    ("POST", "/chat/clear"): lambda event, body: clear_history(event),
+    ("GET", "/files/list"): lambda event, body: list_files(event),
+    ("POST", "/files/read"): read_file,
+    ("POST", "/files/write"): write_file,
+    ("POST", "/files/delete"): delete_file,
+    ("GET", "/memories"): lambda event, body: get_memories(event),
+    ("DELETE", "/memories"): delete_memory,
+}
@@ -3,30 +3,102 @@ Storage utilities for DynamoDB and S3 operations.
 """
 
 import os
-import json
+import orjson
 import hashlib
+import itertools
+import hmac
 import secrets
-from datetime import datetime, timedelta
-from typing import Optional, Dict, Any
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Dict, Any, Tuple
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
+try:
+    from amazondax import AmazonDaxClient
+    HAS_DAX = True
+except ImportError:
+    HAS_DAX = False
+
 # Configuration
 USERS_TABLE = os.environ.get("USERS_TABLE", "delta3-users")
+SESSIONS_TABLE = os.environ.get("SESSIONS_TABLE", "delta3-sessions")
+CHAT_TABLE = os.environ.get("CHAT_TABLE", "delta3-chat")
 FILES_BUCKET = os.environ.get("FILES_BUCKET", "delta3-files")
 MEMORIES_TABLE = os.environ.get("MEMORIES_TABLE", "delta3-memories")
 AWS_REGION = os.environ.get("AWS_REGION", "us-east-1")
-
-# Clients
-dynamodb = boto3.resource("dynamodb", region_name=AWS_REGION)
-s3 = boto3.client("s3", region_name=AWS_REGION)
-users_table = dynamodb.Table(USERS_TABLE)
-memories_table = dynamodb.Table(MEMORIES_TABLE)
+DAX_ENDPOINT = os.environ.get("DAX_ENDPOINT")
+
+# Clients share one session and a keep-alive connection pool across warm invocations
+_session = boto3.session.Session()
+_config = Config(
+    max_pool_connections=50,
+    tcp_keepalive=True,
+    retries={"max_attempts": 3, "mode": "adaptive"}
+)
+dynamodb = _session.resource("dynamodb", region_name=AWS_REGION, config=_config)
+s3 = _session.client(
+    "s3",
+    region_name=AWS_REGION,
+    config=_config.merge(Config(s3={"addressing_style": "virtual"}))
+)
+
+# Hot small-item reads go through DAX when a cluster endpoint is configured
+_cached_dynamodb = (
+    AmazonDaxClient.resource(endpoint_url=DAX_ENDPOINT, region_name=AWS_REGION)
+    if DAX_ENDPOINT and HAS_DAX else dynamodb
+)
+users_table = _cached_dynamodb.Table(USERS_TABLE)
+sessions_table = dynamodb.Table(SESSIONS_TABLE)
+chat_table = dynamodb.Table(CHAT_TABLE)
+memories_table = _cached_dynamodb.Table(MEMORIES_TABLE)
+
+# Best-effort access-stat writes, kept off the memory read path
+_stats_pool = ThreadPoolExecutor(max_workers=1)
+
+# User attributes returned by get_user by default (everything but the password hash)
+USER_FIELDS = ("user_id", "email", "api_key", "gemini_key", "created_at", "last_login")
+
+# Warm containers reuse a verified credential for this many seconds
+AUTH_CACHE_TTL = 60
+AUTH_CACHE_SIZE = 1024
+
+# sha256(credential) -> (user_id, gemini_key, monotonic deadline), least recently used first
+_AUTH_CACHE: "OrderedDict[str, Tuple[str, str, float]]" = OrderedDict()
+
+
+# scrypt cost parameters (16 MB of memory per hash)
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
 
 
 def hash_password(password: str) -> str:
-    """Hash password with SHA256."""
-    return hashlib.sha256(password.encode()).hexdigest()
+    """Hash password with salted scrypt."""
+    salt = secrets.token_bytes(16)
+    digest = hashlib.scrypt(password.encode(), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P)
+    return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${digest.hex()}"
+
+
+def verify_password(password: str, password_hash: str) -> bool:
+    """Check a password against a stored scrypt hash (or a legacy unsalted SHA256 one)."""
+    if not password_hash.startswith("scrypt$"):
+        return hmac.compare_digest(password_hash, hashlib.sha256(password.encode()).hexdigest())
+    _, n, r, p, salt, digest = password_hash.split("$")
+    candidate = hashlib.scrypt(password.encode(), salt=bytes.fromhex(salt), n=int(n), r=int(r), p=int(p))
+    return hmac.compare_digest(candidate.hex(), digest)
+
+
+def _projection(*fields: str) -> Dict[str, Any]:
+    """Read kwargs that fetch only the given top-level attributes."""
+    return {
+        "ProjectionExpression": ", ".join(f"#{field}" for field in fields),
+        "ExpressionAttributeNames": {f"#{field}": field for field in fields}
+    }
 
 
 def generate_api_key() -> str:
@@ -45,14 +117,6 @@ def create_user(email: str, password: str) -> Dict[str, Any]:
     """Create a new user account."""
     user_id = email.lower()
     
-    # Check if exists
-    try:
-        response = users_table.get_item(Key={"user_id": user_id})
-        if "Item" in response:
-            raise ValueError("User already exists")
-    except ClientError:
-        pass
-    
     api_key = generate_api_key()
     
     user = {
@@ -62,11 +126,16 @@ def create_user(email: str, password: str) -> Dict[str, Any]:
         "api_key": api_key,
         "gemini_key": None,
         "created_at": datetime.utcnow().isoformat(),
-        "last_login": None,
-        "sessions": {}
+        "last_login": None
     }
     
-    users_table.put_item(Item=user)
+    # Conditional put: DynamoDB rejects an existing user atomically, in one round-trip
+    try:
+        users_table.put_item(Item=user, ConditionExpression="attribute_not_exists(user_id)")
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            raise ValueError("User already exists")
+        raise
     return {"user_id": user_id, "api_key": api_key}
 
 
@@ -75,27 +144,39 @@ def verify_login(email: str, password: str) -> Optional[Dict[str, Any]]:
     user_id = email.lower()
     
     try:
-        response = users_table.get_item(Key={"user_id": user_id})
+        response = users_table.get_item(
+            Key={"user_id": user_id},
+            **_projection("user_id", "password_hash", "api_key", "gemini_key")
+        )
         if "Item" not in response:
             return None
         
         user = response["Item"]
-        if user["password_hash"] != hash_password(password):
+        if not verify_password(password, user["password_hash"]):
             return None
         
-        # Create session
+        # Create session, one row per token; DynamoDB TTL removes expired rows
         session_token = generate_session_token()
-        expires = (datetime.utcnow() + timedelta(days=7)).isoformat()
+        now = datetime.utcnow()
+        expires_at = now + timedelta(days=7)
+        expires = expires_at.isoformat()
         
-        # Update user with new session
+        sessions_table.put_item(Item={
+            "session_token": session_token,
+            "user_id": user_id,
+            "expires": expires,
+            "ttl": int(expires_at.replace(tzinfo=timezone.utc).timestamp())
+        })
+        update = "SET last_login = :now"
+        values = {":now": now.isoformat()}
+        # Upgrade a legacy SHA256 hash while the plaintext is at hand
+        if not user["password_hash"].startswith("scrypt$"):
+            update += ", password_hash = :hash"
+            values[":hash"] = hash_password(password)
         users_table.update_item(
             Key={"user_id": user_id},
-            UpdateExpression="SET last_login = :now, sessions.#token = :expires",
-            ExpressionAttributeNames={"#token": session_token},
-            ExpressionAttributeValues={
-                ":now": datetime.utcnow().isoformat(),
-                ":expires": expires
-            }
+            UpdateExpression=update,
+            ExpressionAttributeValues=values
         )
         
         return {
@@ -111,46 +192,108 @@ def verify_login(email: str, password: str) -> Optional[Dict[str, Any]]:
 
 def verify_session(session_token: str) -> Optional[str]:
     """Verify session token and return user_id."""
-    # Scan for session (in production, use GSI)
     try:
-        response = users_table.scan(
-            FilterExpression="attribute_exists(sessions.#token)",
-            ExpressionAttributeNames={"#token": session_token}
+        response = sessions_table.get_item(
+            Key={"session_token": session_token},
+            **_projection("user_id", "expires")
         )
+        session = response.get("Item")
         
-        if not response.get("Items"):
-            return None
-        
-        user = response["Items"][0]
-        expires = user.get("sessions", {}).get(session_token)
-        
-        if expires and datetime.fromisoformat(expires) > datetime.utcnow():
-            return user["user_id"]
+        # TTL deletion lags behind expiry, so the timestamp is still checked
+        if session and datetime.fromisoformat(session["expires"]) > datetime.utcnow():
+            return session["user_id"]
         
         return None
     except (ClientError, ValueError):
         return None
 
 
-def verify_api_key(api_key: str) -> Optional[str]:
-    """Verify API key and return user_id."""
+def _scan_for_api_key(api_key: str) -> Optional[Dict[str, Any]]:
+    """Find an API key's user with a full scan, while ApiKeyIndex is missing or backfilling."""
+    kwargs = {
+        "FilterExpression": "api_key = :key",
+        "ExpressionAttributeValues": {":key": api_key}
+    }
+    while True:
+        response = users_table.scan(**kwargs)
+        if response.get("Items"):
+            return response["Items"][0]
+        if "LastEvaluatedKey" not in response:
+            return None
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def get_user_by_api_key(api_key: str) -> Optional[Dict[str, Any]]:
+    """Get the user owning an API key.
+
+    ApiKeyIndex projects the whole user item, so no follow-up get_user is needed.
+    """
     try:
-        response = users_table.scan(
-            FilterExpression="api_key = :key",
-            ExpressionAttributeValues={":key": api_key}
+        response = users_table.query(
+            IndexName="ApiKeyIndex",
+            KeyConditionExpression="api_key = :key",
+            ExpressionAttributeValues={":key": api_key},
+            Limit=1
         )
         
         if response.get("Items"):
-            return response["Items"][0]["user_id"]
+            return response["Items"][0]
         return None
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ValidationException":
+            return None
+    
+    try:
+        return _scan_for_api_key(api_key)
     except ClientError:
         return None
 
 
-def get_user(user_id: str) -> Optional[Dict[str, Any]]:
-    """Get user by ID."""
+def verify_api_key(api_key: str) -> Optional[str]:
+    """Verify API key and return user_id."""
+    user = get_user_by_api_key(api_key)
+    return user["user_id"] if user else None
+
+
+def authenticate(session_token: str = None, api_key: str = None) -> Optional[Tuple[str, Optional[str]]]:
+    """Resolve a session token or API key to (user_id, gemini_key).
+
+    Verified users with a Gemini key are cached for AUTH_CACHE_TTL seconds,
+    so warm requests skip both the credential lookup and the user fetch.
+    """
+    credential = session_token or api_key
+    if not credential:
+        return None
+    
+    cache_key = hashlib.sha256(credential.encode()).hexdigest()
+    entry = _AUTH_CACHE.get(cache_key)
+    if entry and entry[2] > time.monotonic():
+        _AUTH_CACHE.move_to_end(cache_key)
+        return entry[0], entry[1]
+    _AUTH_CACHE.pop(cache_key, None)
+    
+    if session_token:
+        user_id = verify_session(session_token)
+        user = get_user(user_id, ("user_id", "gemini_key")) if user_id else None
+    else:
+        user = get_user_by_api_key(api_key)
+    if not user:
+        return None
+    user_id = user["user_id"]
+    
+    gemini_key = user.get("gemini_key")
+    # Users without a key are not cached, so setting one takes effect immediately
+    if gemini_key:
+        _AUTH_CACHE[cache_key] = (user_id, gemini_key, time.monotonic() + AUTH_CACHE_TTL)
+        if len(_AUTH_CACHE) > AUTH_CACHE_SIZE:
+            _AUTH_CACHE.popitem(last=False)
+    return user_id, gemini_key
+
+
+def get_user(user_id: str, fields: Tuple[str, ...] = USER_FIELDS) -> Optional[Dict[str, Any]]:
+    """Get user by ID, reading only the given attributes."""
     try:
-        response = users_table.get_item(Key={"user_id": user_id})
+        response = users_table.get_item(Key={"user_id": user_id}, **_projection(*fields))
         return response.get("Item")
     except ClientError:
         return None
@@ -164,6 +307,9 @@ def update_gemini_key(user_id: str, gemini_key: str) -> bool:
             UpdateExpression="SET gemini_key = :key",
             ExpressionAttributeValues={":key": gemini_key}
         )
+        for cache_key, entry in list(_AUTH_CACHE.items()):
+            if entry[0] == user_id:
+                del _AUTH_CACHE[cache_key]
         return True
     except ClientError:
         return False
@@ -210,25 +356,24 @@ def read_file(user_id: str, path: str) -> Optional[str]:
         return None
 
 
-def list_files(user_id: str, path: str = "") -> list:
-    """List files in user's directory."""
+def list_files(user_id: str, path: str = "", limit: int = 1000, continuation: str = None) -> Dict[str, Any]:
+    """List one page of a user's directory; "next" continues the listing when set."""
     if path.startswith("/"):
         path = path[1:]
     
     prefix = f"{get_user_prefix(user_id)}{path}"
+    request = {"Bucket": FILES_BUCKET, "Prefix": prefix, "Delimiter": "/", "MaxKeys": limit}
+    if continuation:
+        request["ContinuationToken"] = continuation
     
     try:
-        response = s3.list_objects_v2(
-            Bucket=FILES_BUCKET,
-            Prefix=prefix,
-            Delimiter="/"
-        )
+        response = s3.list_objects_v2(**request)
         
         files = []
         
         # Files
         for obj in response.get("Contents", []):
-            name = obj["Key"].replace(prefix, "")
+            name = obj["Key"][len(prefix):]
             if name:
                 files.append({
                     "name": name,
@@ -239,16 +384,16 @@ def list_files(user_id: str, path: str = "") -> list:
         
         # Directories
         for prefix_obj in response.get("CommonPrefixes", []):
-            name = prefix_obj["Prefix"].replace(prefix, "").rstrip("/")
+            name = prefix_obj["Prefix"][len(prefix):].rstrip("/")
             if name:
                 files.append({
                     "name": name,
                     "type": "directory"
                 })
         
-        return files
+        return {"files": files, "next": response.get("NextContinuationToken")}
     except ClientError:
-        return []
+        return {"files": [], "next": None}
 
 
 def delete_file(user_id: str, path: str) -> bool:
@@ -267,59 +412,89 @@ def delete_file(user_id: str, path: str) -> bool:
 
 # === Chat History ===
 
-def save_chat_message(user_id: str, role: str, content: str, tool_calls: list = None):
-    """Save chat message to history."""
-    key = f"{get_user_prefix(user_id)}chat_history.json"
-    
-    # Load existing
-    try:
-        response = s3.get_object(Bucket=FILES_BUCKET, Key=key)
-        history = json.loads(response["Body"].read().decode("utf-8"))
-    except ClientError:
-        history = []
-    
-    # Append message
-    message = {
+# Chat messages expire this many days after they are written
+CHAT_HISTORY_TTL_DAYS = 30
+
+
+def _chat_item(user_id: str, now: datetime, role: str, content: str, tool_calls: list = None) -> dict:
+    """Build the chat table item for one message."""
+    timestamp = now.isoformat()
+    item = {
+        "user_id": user_id,
+        "message_id": f"{timestamp}#{uuid.uuid4().hex[:8]}",
         "role": role,
         "content": content,
-        "timestamp": datetime.utcnow().isoformat()
+        "timestamp": timestamp,
+        "ttl": int((now + timedelta(days=CHAT_HISTORY_TTL_DAYS)).replace(tzinfo=timezone.utc).timestamp())
     }
+    # Stored as JSON text, since DynamoDB rejects the floats tool arguments may hold
     if tool_calls:
-        message["tool_calls"] = tool_calls
-    
-    history.append(message)
-    
-    # Keep last 100 messages
-    if len(history) > 100:
-        history = history[-100:]
-    
-    # Save
-    s3.put_object(
-        Bucket=FILES_BUCKET,
-        Key=key,
-        Body=json.dumps(history).encode("utf-8"),
-        ContentType="application/json"
-    )
+        item["tool_calls"] = orjson.dumps(tool_calls).decode()
+    return item
+
+
+def save_chat_message(user_id: str, role: str, content: str, tool_calls: list = None):
+    """Save chat message to history."""
+    chat_table.put_item(Item=_chat_item(user_id, datetime.utcnow(), role, content, tool_calls))
+
+
+def save_chat_messages(user_id: str, messages: list):
+    """Save several chat messages (dicts with role, content and optional tool_calls) in one batch."""
+    now = datetime.utcnow()
+    with chat_table.batch_writer() as batch:
+        for i, message in enumerate(messages):
+            # Offset each timestamp so the messages keep their order in the sort key
+            batch.put_item(Item=_chat_item(
+                user_id,
+                now + timedelta(microseconds=i),
+                message["role"],
+                message["content"],
+                message.get("tool_calls")
+            ))
 
 
 def get_chat_history(user_id: str, limit: int = 20) -> list:
     """Get recent chat history."""
-    key = f"{get_user_prefix(user_id)}chat_history.json"
-    
     try:
-        response = s3.get_object(Bucket=FILES_BUCKET, Key=key)
-        history = json.loads(response["Body"].read().decode("utf-8"))
-        return history[-limit:]
+        response = chat_table.query(
+            KeyConditionExpression="user_id = :uid",
+            ExpressionAttributeValues={":uid": user_id},
+            ScanIndexForward=False,
+            Limit=limit
+        )
     except ClientError:
         return []
+    
+    history = []
+    for item in reversed(response.get("Items", [])):
+        message = {
+            "role": item["role"],
+            "content": item["content"],
+            "timestamp": item["timestamp"]
+        }
+        if item.get("tool_calls"):
+            message["tool_calls"] = orjson.loads(item["tool_calls"])
+        history.append(message)
+    return history
 
 
 def clear_chat_history(user_id: str) -> bool:
     """Clear chat history."""
-    key = f"{get_user_prefix(user_id)}chat_history.json"
-
+    query = {
+        "KeyConditionExpression": "user_id = :uid",
+        "ExpressionAttributeValues": {":uid": user_id},
+        "ProjectionExpression": "message_id"
+    }
+    
     try:
-        s3.delete_object(Bucket=FILES_BUCKET, Key=key)
+        with chat_table.batch_writer() as batch:
+            while True:
+                response = chat_table.query(**query)
+                for item in response.get("Items", []):
+                    batch.delete_item(Key={"user_id": user_id, "message_id": item["message_id"]})
+                if "LastEvaluatedKey" not in response:
+                    break
+                query["ExclusiveStartKey"] = response["LastEvaluatedKey"]
         return True
     except ClientError:
         return False
@@ -327,6 +502,21 @@ def clear_chat_history(user_id: str) -> bool:
 
 # === Memory Management ===
 
+# (epoch second, formatted timestamp) for the most recent now_iso() call
+_clock = [0, ""]
+
+# Per-process sequence that keeps same-second memory_ids in creation order
+_memory_seq = itertools.count()
+
+
+def now_iso() -> str:
+    """UTC timestamp to the second, formatted once per second."""
+    t = int(time.time())
+    if t != _clock[0]:
+        _clock[:] = [t, datetime.fromtimestamp(t, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")]
+    return _clock[1]
+
+
 def save_memory(
     user_id: str,
     content: str,
@@ -336,10 +526,8 @@ def save_memory(
     source_context: str = None
 ) -> dict:
     """Save a new memory."""
-    import uuid
-
-    timestamp = datetime.utcnow().isoformat() + 'Z'
-    memory_id = f"{timestamp}#{uuid.uuid4().hex[:8]}"
+    timestamp = now_iso()
+    memory_id = f"{timestamp}#{next(_memory_seq):06d}{uuid.uuid4().hex[:8]}"
 
     item = {
         "user_id": user_id,
@@ -402,9 +590,8 @@ def get_memories(
         if tags:
             memories = [m for m in memories if any(t in m.get("tags", []) for t in tags)]
 
-        # Update access stats for top 10 memories
-        for memory in memories[:10]:
-            _increment_access_count(user_id, memory["memory_id"])
+        # Update access stats for top 10 memories off the request path
+        _stats_pool.submit(_increment_access_counts, user_id, [m["memory_id"] for m in memories[:10]])
 
         return memories
 
@@ -413,6 +600,48 @@ def get_memories(
         return []
 
 
+def get_context_memories(
+    user_id: str,
+    critical_min: int = 9,
+    recent_min: int = 6,
+    days: int = 7,
+    limit: int = 15
+) -> list:
+    """Get critical memories plus recent important ones in a single query, most important first."""
+    week_ago = (datetime.utcnow() - timedelta(days=days)).isoformat()
+    query = {
+        "KeyConditionExpression": "user_id = :uid",
+        "FilterExpression": "importance >= :crit OR (importance >= :imp AND created_at >= :since)",
+        "ExpressionAttributeValues": {
+            ":uid": user_id,
+            ":crit": critical_min,
+            ":imp": recent_min,
+            ":since": week_ago
+        },
+        "ScanIndexForward": False
+    }
+
+    try:
+        memories = []
+        while len(memories) < limit:
+            response = memories_table.query(**query)
+            memories.extend(response.get("Items", []))
+            if "LastEvaluatedKey" not in response:
+                break
+            query["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+        memories = sorted(memories[:limit], key=lambda m: m.get("importance", 0), reverse=True)
+
+        # Update access stats for top 10 memories off the request path
+        _stats_pool.submit(_increment_access_counts, user_id, [m["memory_id"] for m in memories[:10]])
+
+        return memories
+
+    except ClientError as e:
+        print(f"Error getting context memories: {e}")
+        return []
+
+
 def search_memories(user_id: str, query: str, limit: int = 5) -> list:
     """Search memories by keyword (simple text matching)."""
     all_memories = get_memories(user_id, limit=100)
@@ -436,7 +665,7 @@ def update_memory(user_id: str, memory_id: str, new_content: str = None, importa
     """Update an existing memory."""
     try:
         update_expr = "SET last_accessed = :now"
-        expr_values = {":now": datetime.utcnow().isoformat() + 'Z'}
+        expr_values = {":now": now_iso()}
 
         if new_content:
             update_expr += ", content = :content"
@@ -468,16 +697,22 @@ def delete_memory(user_id: str, memory_id: str) -> bool:
         return False
 
 
-def _increment_access_count(user_id: str, memory_id: str):
-    """Increment access count for a memory."""
+def _increment_access_counts(user_id: str, memory_ids: list):
+    """Increment access counts for several memories in one transactional write."""
+    if not memory_ids:
+        return
+    now = now_iso()
     try:
-        memories_table.update_item(
-            Key={"user_id": user_id, "memory_id": memory_id},
-            UpdateExpression="SET access_count = access_count + :inc, last_accessed = :now",
-            ExpressionAttributeValues={
-                ":inc": 1,
-                ":now": datetime.utcnow().isoformat() + 'Z'
+        memories_table.meta.client.transact_write_items(TransactItems=[
+            {
+                "Update": {
+                    "TableName": MEMORIES_TABLE,
+                    "Key": {"user_id": {"S": user_id}, "memory_id": {"S": memory_id}},
+                    "UpdateExpression": "SET access_count = access_count + :inc, last_accessed = :now",
+                    "ExpressionAttributeValues": {":inc": {"N": "1"}, ":now": {"S": now}}
+                }
             }
-        )
+            for memory_id in memory_ids
+        ])
     except ClientError:
         pass  # Non-critical, fail silently
@@ -2,21 +2,64 @@
 Gemini AI integration for code execution with S3 persistence.
 """
 
+import base64
+import collections
+import functools
+import hashlib
+import io
 import json
 import subprocess
-import tempfile
 import os
 import shutil
-from typing import Dict, Any, List, Optional
+import signal
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Any, List, Union
 from google import genai
 from google.genai import types
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
-# S3 client
-s3 = boto3.client("s3", region_name=os.environ.get("AWS_REGION", "us-east-1"))
+# S3 client, with a pool large enough for the parallel restore
+s3 = boto3.client(
+    "s3",
+    region_name=os.environ.get("AWS_REGION", "us-east-1"),
+    config=Config(
+        max_pool_connections=50,
+        tcp_keepalive=True,
+        retries={"max_attempts": 5, "mode": "adaptive"}
+    )
+)
 FILES_BUCKET = os.environ.get("FILES_BUCKET", "delta3-files")
 
+# Files above this size are uploaded in parallel multipart chunks
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+_multipart_config = TransferConfig(multipart_threshold=MULTIPART_THRESHOLD, max_concurrency=10)
+
+# Concurrent downloads when restoring a workspace
+RESTORE_WORKERS = 32
+
+# Background S3 uploads from write_file, shared across warm invocations
+_sync_pool = ThreadPoolExecutor(max_workers=4)
+
+# user_id -> {relative path: S3 ETag} of local files known to match S3,
+# kept (like /tmp itself) across warm invocations
+_WORKSPACE_ETAGS: Dict[str, Dict[str, str]] = {}
+
+# user_id -> executor, handed to each new agent for that user in this container
+_EXECUTORS: Dict[str, "PersistentCodeExecutor"] = {}
+
+# stdout/stderr beyond this are cut to their tail before reaching Gemini
+MAX_OUTPUT_CHARS = 8192
+
+# read_file returns at most this many characters of a file
+MAX_READ_CHARS = 64 * 1024
+
+# Scratch file execute_python writes each script to
+EXEC_SCRIPT_NAME = ".__exec.py"
+
 # Tool definitions for Gemini
 TOOLS = [
     types.Tool(
@@ -130,6 +173,94 @@ When asked to write code:
 Always verify your work by checking outputs."""
 
 
+# Sent with every model call; built once per container
+_GEN_CONFIG = types.GenerateContentConfig(
+    tools=TOOLS,
+    system_instruction=SYSTEM_PROMPT
+)
+
+# Stored chat roles mapped to Gemini content roles; anything else is not replayed
+_HISTORY_ROLES = {"user": "user", "assistant": "model"}
+
+
+def _drain_tail(stream, limit: int = MAX_OUTPUT_CHARS) -> str:
+    """Read a pipe to EOF, keeping and decoding only its last limit bytes."""
+    chunks = collections.deque()
+    kept = total = 0
+    for chunk in iter(lambda: stream.read1(65536), b""):
+        chunks.append(chunk)
+        kept += len(chunk)
+        total += len(chunk)
+        while kept - len(chunks[0]) >= limit:
+            kept -= len(chunks.popleft())
+    
+    data = b"".join(chunks)[-limit:].decode("utf-8", errors="replace")
+    if total > limit:
+        return f"...[{total - limit} bytes truncated]\n{data}"
+    return data
+
+
+def _kill_group(proc: subprocess.Popen):
+    """SIGKILL a child's whole process group, including anything it left running."""
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass  # Group already gone
+
+
+def _run_capped(args, timeout: float = 60, **kwargs) -> Dict[str, Any]:
+    """Like subprocess.run, but holding at most MAX_OUTPUT_CHARS of each stream.
+
+    The child gets its own process group, which is killed on timeout and
+    after exit so background processes can't hold the pipes open.
+    Raises subprocess.TimeoutExpired after killing the process.
+    """
+    proc = subprocess.Popen(
+        args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True, **kwargs
+    )
+    output = {}
+    streams = (("stdout", proc.stdout), ("stderr", proc.stderr))
+    readers = [
+        threading.Thread(target=lambda n=name, st=stream: output.__setitem__(n, _drain_tail(st)), daemon=True)
+        for name, stream in streams
+    ]
+    for reader in readers:
+        reader.start()
+    
+    try:
+        proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        _kill_group(proc)
+        proc.wait()
+        raise
+    finally:
+        _kill_group(proc)
+        for reader in readers:
+            reader.join(timeout=5)
+        # Closing a pipe under a live reader would block on its lock until EOF
+        for reader, (_, stream) in zip(readers, streams):
+            if not reader.is_alive():
+                stream.close()
+    
+    return {
+        "stdout": output.get("stdout", ""),
+        "stderr": output.get("stderr", ""),
+        "exit_code": proc.returncode
+    }
+
+
+def _merge_text_parts(parts: List[types.Part]) -> List[types.Part]:
+    """Join the consecutive text chunks of a streamed turn into single parts."""
+    merged = []
+    for part in parts:
+        if (part.text and not part.thought and merged and merged[-1].text
+                and not merged[-1].thought):
+            merged[-1] = types.Part(text=merged[-1].text + part.text)
+        else:
+            merged.append(part)
+    return merged
+
+
 class PersistentCodeExecutor:
     """Executes code with S3-backed persistent storage."""
     
@@ -137,47 +268,106 @@ class PersistentCodeExecutor:
         self.user_id = user_id
         self.workspace = f"/tmp/workspace_{user_id.replace('@', '_').replace('.', '_')}"
         self.s3_prefix = f"users/{user_id}/workspace/"
+        self._child_env = {**os.environ, "PYTHONPATH": self.workspace}
+        # path -> latest background upload of that path
+        self._uploads: Dict[str, Future] = {}
         self._setup_workspace()
     
     def _setup_workspace(self):
-        """Setup workspace by restoring files from S3."""
-        # Clean and create workspace
-        if os.path.exists(self.workspace):
-            shutil.rmtree(self.workspace)
+        """Bring the workspace in line with S3, downloading only changed files."""
+        if not os.path.isdir(self.workspace):
+            _WORKSPACE_ETAGS.pop(self.user_id, None)
         os.makedirs(self.workspace, exist_ok=True)
+        self._etags = _WORKSPACE_ETAGS.setdefault(self.user_id, {})
+        # Set once code runs, since it may change files behind the ETag map
+        self._dirty = False
         
         # Restore files from S3
+        listed = set()
+        downloads = []
         try:
             paginator = s3.get_paginator('list_objects_v2')
             for page in paginator.paginate(Bucket=FILES_BUCKET, Prefix=self.s3_prefix):
                 for obj in page.get('Contents', []):
                     key = obj['Key']
                     relative_path = key.replace(self.s3_prefix, '')
-                    if relative_path:
-                        local_path = os.path.join(self.workspace, relative_path)
-                        os.makedirs(os.path.dirname(local_path), exist_ok=True)
-                        s3.download_file(FILES_BUCKET, key, local_path)
-        except ClientError:
-            pass  # No files yet, that's okay
+                    if not relative_path:
+                        continue
+                    listed.add(relative_path)
+                    local_path = os.path.join(self.workspace, relative_path)
+                    if (self._etags.get(relative_path) == obj.get('ETag')
+                            and os.path.isfile(local_path)
+                            and os.path.getsize(local_path) == obj.get('Size')):
+                        continue
+                    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+                    downloads.append((key, local_path, relative_path, obj.get('ETag')))
+        except ClientError as e:
+            # A partial listing would make unlisted files look deleted; leave them
+            print(f"S3 list error: {e}")
+            return
+        
+        def download(item):
+            key, local_path, relative_path, etag = item
+            s3.download_file(FILES_BUCKET, key, local_path)
+            self._etags[relative_path] = etag
+        
+        try:
+            # Directories exist already, so the downloads can run concurrently
+            with ThreadPoolExecutor(max_workers=RESTORE_WORKERS) as pool:
+                list(pool.map(download, downloads))
+        except ClientError as e:
+            print(f"S3 restore error: {e}")
+        
+        # Remove files that are no longer (or never were) in S3
+        for root, _, names in os.walk(self.workspace, topdown=False):
+            for name in names:
+                local_path = os.path.join(root, name)
+                if os.path.relpath(local_path, self.workspace) not in listed:
+                    os.unlink(local_path)
+            if root != self.workspace and not os.listdir(root):
+                os.rmdir(root)
+        for relative_path in list(self._etags):
+            if relative_path not in listed:
+                del self._etags[relative_path]
     
-    def _sync_to_s3(self, path: str, content: str = None):
+    def _sync_to_s3(self, path: str, content: Union[str, bytes] = None):
         """Sync a file to S3."""
         # Normalize path
         if path.startswith("/"):
             path = path[1:]
         if path.startswith("tmp/workspace"):
-            path = path.split("/", 3)[-1] if len(path.split("/")) > 3 else ""
+            # tmp/<workspace dir>/<relative path>
+            parts = path.split("/", 2)
+            path = parts[2] if len(parts) > 2 else ""
         
         s3_key = f"{self.s3_prefix}{path}"
         
+        if content is not None:
+            # Encode and hash once; the digest is both the skip check and ContentMD5
+            body = content.encode('utf-8') if isinstance(content, str) else content
+            digest = hashlib.md5(body).digest()
+            if self._etags.get(path) == f'"{digest.hex()}"':
+                return
+        
+        self._etags.pop(path, None)
         try:
-            if content is not None:
-                s3.put_object(
+            if content is not None and len(body) > MULTIPART_THRESHOLD:
+                s3.upload_fileobj(
+                    io.BytesIO(body), FILES_BUCKET, s3_key,
+                    ExtraArgs={"ContentType": "text/plain"},
+                    Config=_multipart_config
+                )
+            elif content is not None:
+                result = s3.put_object(
                     Bucket=FILES_BUCKET,
                     Key=s3_key,
-                    Body=content.encode('utf-8'),
+                    Body=body,
+                    ContentMD5=base64.b64encode(digest).decode(),
                     ContentType='text/plain'
                 )
+                # Code that ran since the write may have changed the local copy
+                if not self._dirty:
+                    self._etags[path] = result.get("ETag")
             else:
                 # Read from local file
                 local_path = os.path.join(self.workspace, path)
@@ -186,6 +376,35 @@ class PersistentCodeExecutor:
         except ClientError as e:
             print(f"S3 sync error: {e}")
     
+    def _queue_upload(self, path: str, content: str):
+        """Upload a written file in the background, after any earlier upload of it."""
+        previous = self._uploads.get(path)
+        
+        def upload():
+            if previous:
+                previous.result()
+            self._sync_to_s3(path, content)
+        
+        self._uploads[path] = _sync_pool.submit(upload)
+    
+    def _wait_uploads(self, path: str = None):
+        """Wait for pending uploads of a path and anything under it (all by default)."""
+        for upload_path in list(self._uploads):
+            if path is None or upload_path == path or upload_path.startswith(f"{path}/"):
+                try:
+                    self._uploads.pop(upload_path).result()
+                except Exception as e:
+                    print(f"S3 sync error: {e}")
+    
+    def flush(self):
+        """Block until every background upload has reached S3."""
+        self._wait_uploads()
+    
+    def refresh(self):
+        """Re-index a reused workspace against S3 (one listing plus ETag compare)."""
+        self.flush()
+        self._setup_workspace()
+    
     def _delete_from_s3(self, path: str):
         """Delete a file from S3."""
         if path.startswith("/"):
@@ -198,37 +417,27 @@ class PersistentCodeExecutor:
         except ClientError:
             pass
     
+    def _mark_dirty(self):
+        """Stop trusting local copies once code runs, since it can edit them in place."""
+        self._dirty = True
+        self._etags.clear()
+    
     def execute_python(self, code: str) -> Dict[str, Any]:
         """Execute Python code."""
+        self._mark_dirty()
         try:
-            # Write to temp file
-            with tempfile.NamedTemporaryFile(
-                mode="w", 
-                suffix=".py", 
-                dir=self.workspace,
-                delete=False
-            ) as f:
+            # Overwrite one fixed script instead of creating a temp file per run
+            script_path = os.path.join(self.workspace, EXEC_SCRIPT_NAME)
+            with open(script_path, "w") as f:
                 f.write(code)
-                script_path = f.name
             
             # Execute
-            result = subprocess.run(
+            return _run_capped(
                 ["python3", script_path],
-                capture_output=True,
-                text=True,
                 timeout=60,
                 cwd=self.workspace,
-                env={**os.environ, "PYTHONPATH": self.workspace}
+                env=self._child_env
             )
-            
-            # Cleanup temp script
-            os.unlink(script_path)
-            
-            return {
-                "stdout": result.stdout,
-                "stderr": result.stderr,
-                "exit_code": result.returncode
-            }
         except subprocess.TimeoutExpired:
             return {"stdout": "", "stderr": "Execution timed out (60s limit)", "exit_code": -1}
         except Exception as e:
@@ -236,21 +445,14 @@ class PersistentCodeExecutor:
     
     def execute_shell(self, command: str) -> Dict[str, Any]:
         """Execute shell command."""
+        self._mark_dirty()
         try:
-            result = subprocess.run(
+            return _run_capped(
                 command,
                 shell=True,
-                capture_output=True,
-                text=True,
                 timeout=60,
                 cwd=self.workspace
             )
-            
-            return {
-                "stdout": result.stdout,
-                "stderr": result.stderr,
-                "exit_code": result.returncode
-            }
         except subprocess.TimeoutExpired:
             return {"stdout": "", "stderr": "Command timed out (60s limit)", "exit_code": -1}
         except Exception as e:
@@ -262,13 +464,17 @@ class PersistentCodeExecutor:
             # Normalize path
             clean_path = path.lstrip("/")
             full_path = os.path.join(self.workspace, clean_path)
-            os.makedirs(os.path.dirname(full_path) if os.path.dirname(full_path) else self.workspace, exist_ok=True)
-            
-            with open(full_path, "w") as f:
+            try:
+                f = open(full_path, "w")
+            except FileNotFoundError:
+                # Only create parent directories when they are actually missing
+                os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                f = open(full_path, "w")
+            with f:
                 f.write(content)
             
-            # Sync to S3 for persistence
-            self._sync_to_s3(clean_path, content)
+            # Sync to S3 for persistence without holding up the next tool call
+            self._queue_upload(clean_path, content)
             
             return {"success": True, "path": clean_path}
         except Exception as e:
@@ -280,8 +486,11 @@ class PersistentCodeExecutor:
             clean_path = path.lstrip("/")
             full_path = os.path.join(self.workspace, clean_path)
             
-            with open(full_path, "r") as f:
-                content = f.read()
+            # Read one character past the cap to tell whether the file is longer
+            with open(full_path, "r", errors="replace") as f:
+                content = f.read(MAX_READ_CHARS + 1)
+            if len(content) > MAX_READ_CHARS:
+                content = f"{content[:MAX_READ_CHARS]}\n...[truncated at {MAX_READ_CHARS} chars]"
             
             return {"success": True, "content": content}
         except FileNotFoundError:
@@ -298,17 +507,19 @@ class PersistentCodeExecutor:
             if not os.path.exists(full_path):
                 return {"success": True, "files": []}
             
+            # DirEntry carries the file type from the directory read, so only files need a stat
             files = []
-            for name in os.listdir(full_path):
-                item_path = os.path.join(full_path, name)
-                # Skip temp files
-                if name.startswith("tmp") and name.endswith(".py"):
-                    continue
-                files.append({
-                    "name": name,
-                    "type": "directory" if os.path.isdir(item_path) else "file",
-                    "size": os.path.getsize(item_path) if os.path.isfile(item_path) else None
-                })
+            with os.scandir(full_path) as entries:
+                for entry in entries:
+                    # Skip the scratch script
+                    if entry.name == EXEC_SCRIPT_NAME:
+                        continue
+                    is_file = entry.is_file()
+                    files.append({
+                        "name": entry.name,
+                        "type": "directory" if entry.is_dir() else "file",
+                        "size": entry.stat().st_size if is_file else None
+                    })
             
             return {"success": True, "files": files}
         except Exception as e:
@@ -319,6 +530,8 @@ class PersistentCodeExecutor:
         try:
             clean_path = path.lstrip("/")
             full_path = os.path.join(self.workspace, clean_path)
+            # A queued upload landing after the delete would resurrect the file
+            self._wait_uploads(clean_path)
             
             if os.path.exists(full_path):
                 if os.path.isdir(full_path):
@@ -334,13 +547,38 @@ class PersistentCodeExecutor:
             return {"success": False, "error": str(e)}
 
 
+def _get_executor(user_id: str) -> PersistentCodeExecutor:
+    """Reuse the user's executor from an earlier agent, re-syncing its workspace with S3."""
+    executor = _EXECUTORS.get(user_id)
+    if executor is None:
+        executor = _EXECUTORS[user_id] = PersistentCodeExecutor(user_id)
+    else:
+        executor.refresh()
+    return executor
+
+
+def release_workspace(user_id: str):
+    """Forget a user's executor and ETag map and remove their local workspace copy."""
+    executor = _EXECUTORS.pop(user_id, None)
+    _WORKSPACE_ETAGS.pop(user_id, None)
+    if executor:
+        executor.flush()
+        shutil.rmtree(executor.workspace, ignore_errors=True)
+
+
+@functools.lru_cache(maxsize=128)
+def _get_genai_client(api_key: str) -> genai.Client:
+    """Gemini client per API key, reused across warm invocations."""
+    return genai.Client(api_key=api_key)
+
+
 class GeminiAgent:
     """Gemini-powered coding agent with persistent environment."""
     
     def __init__(self, api_key: str, user_id: str, chat_history: List[Dict] = None):
-        self.client = genai.Client(api_key=api_key)
+        self.client = _get_genai_client(api_key)
         self.user_id = user_id
-        self.executor = PersistentCodeExecutor(user_id)
+        self.executor = _get_executor(user_id)
         self.history: List[types.Content] = []
         
         # Load chat history into context
@@ -352,20 +590,11 @@ class GeminiAgent:
         # Only load recent messages to stay within context limits
         recent = chat_history[-10:] if len(chat_history) > 10 else chat_history
         
-        for msg in recent:
-            role = msg.get("role", "user")
-            content = msg.get("content", "")
-            
-            if role == "user":
-                self.history.append(types.Content(
-                    role="user",
-                    parts=[types.Part.from_text(text=content)]
-                ))
-            elif role == "assistant":
-                self.history.append(types.Content(
-                    role="model",
-                    parts=[types.Part.from_text(text=content)]
-                ))
+        self.history.extend(
+            types.Content(role=_HISTORY_ROLES[msg.get("role", "user")], parts=[types.Part(text=msg["content"])])
+            for msg in recent
+            if msg.get("content") and msg.get("role", "user") in _HISTORY_ROLES
+        )
     
     def execute_tool(self, name: str, args: Dict) -> str:
         """Execute a tool and return result as string."""
@@ -425,6 +654,42 @@ class GeminiAgent:
     
     def process_message(self, user_message: str) -> Dict[str, Any]:
         """Process user message and return response with tool calls."""
+        try:
+            return self._process_message(user_message)
+        finally:
+            # Files must be durable in S3 before the invocation returns
+            self.executor.flush()
+    
+    def _stream_turn(self):
+        """Stream one model turn, starting each tool call as soon as it arrives.
+
+        Tools run one at a time on a single worker, in the order the model
+        issued them, so the executor never sees concurrent calls.
+        """
+        parts = []
+        calls = []
+        futures = []
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            stream = self.client.models.generate_content_stream(
+                model="gemini-2.0-flash",
+                contents=self.history,
+                config=_GEN_CONFIG
+            )
+            for chunk in stream:
+                if not chunk.candidates or not chunk.candidates[0].content:
+                    continue
+                for part in chunk.candidates[0].content.parts or []:
+                    parts.append(part)
+                    if part.function_call:
+                        fc = part.function_call
+                        call = (fc.name, dict(fc.args) if fc.args else {})
+                        calls.append(call)
+                        futures.append(pool.submit(self.execute_tool, *call))
+            results = [future.result() for future in futures]
+        return _merge_text_parts(parts), calls, results
+    
+    def _process_message(self, user_message: str) -> Dict[str, Any]:
+        """Run the model/tool loop for one user message."""
         # Add user message to history
         self.history.append(types.Content(
             role="user",
@@ -436,59 +701,42 @@ class GeminiAgent:
         final_text = ""
         
         for _ in range(max_iterations):
-            # Generate response
+            # Stream the response, running tools while it is still arriving
             try:
-                response = self.client.models.generate_content(
-                    model="gemini-2.0-flash",
-                    contents=self.history,
-                    config=types.GenerateContentConfig(
-                        tools=TOOLS,
-                        system_instruction=SYSTEM_PROMPT
-                    )
-                )
+                parts, calls, results = self._stream_turn()
             except Exception as e:
                 return {
                     "response": f"Error calling Gemini: {str(e)}",
                     "tool_calls": tool_calls
                 }
             
-            if not response.candidates or not response.candidates[0].content.parts:
+            if not parts:
                 return {
                     "response": final_text if final_text else "No response generated",
                     "tool_calls": tool_calls
                 }
             
             # Add to history
-            self.history.append(response.candidates[0].content)
+            self.history.append(types.Content(role="model", parts=parts))
             
-            # Process parts
-            has_tool_calls = False
+            text = "".join(part.text for part in parts if part.text)
+            if text:
+                final_text = text
             tool_response_parts = []
             
-            for part in response.candidates[0].content.parts:
-                if part.function_call:
-                    has_tool_calls = True
-                    fc = part.function_call
-                    args = dict(fc.args) if fc.args else {}
-                    
-                    # Execute tool
-                    result = self.execute_tool(fc.name, args)
-                    
-                    tool_calls.append({
-                        "tool": fc.name,
-                        "args": args,
-                        "result": result[:500]  # Truncate for response
-                    })
-                    
-                    tool_response_parts.append(types.Part.from_function_response(
-                        name=fc.name,
-                        response={"result": result}
-                    ))
+            for (name, args), result in zip(calls, results):
+                tool_calls.append({
+                    "tool": name,
+                    "args": args,
+                    "result": result[:500]  # Truncate for response
+                })
                 
-                elif part.text:
-                    final_text = part.text
+                tool_response_parts.append(types.Part.from_function_response(
+                    name=name,
+                    response={"result": result}
+                ))
             
-            if not has_tool_calls:
+            if not calls:
                 return {
                     "response": final_text,
                     "tool_calls": tool_calls
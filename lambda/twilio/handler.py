@@ -3,18 +3,77 @@ Twilio SMS webhook handler.
 Receives SMS messages and responds via Gemini.
 """
 
+import base64
 import json
 import os
+import time
 import urllib.parse
+from collections import OrderedDict
 
 import storage
-from gemini import GeminiAgent
+from gemini import GeminiAgent, release_workspace
 
 # Twilio credentials from environment
 TWILIO_ACCOUNT_SID = os.environ.get("TWILIO_ACCOUNT_SID")
 TWILIO_AUTH_TOKEN = os.environ.get("TWILIO_AUTH_TOKEN")
 TWILIO_PHONE_NUMBER = os.environ.get("TWILIO_PHONE_NUMBER")
 
+# Warm containers keep a user's agent (workspace + Gemini context) for one burst of messages
+AGENT_CACHE_TTL = 60
+AGENT_CACHE_SIZE = 32
+
+# user_id -> (agent, gemini_key, monotonic deadline), least recently used first
+_AGENTS: "OrderedDict[str, tuple]" = OrderedDict()
+
+
+def _get_agent(user_id: str, gemini_key: str) -> GeminiAgent:
+    """Reuse this user's agent from an earlier warm invocation, or build one with its history."""
+    entry = _AGENTS.pop(user_id, None)
+    if entry and entry[1] == gemini_key and entry[2] > time.monotonic():
+        agent = entry[0]
+        agent.executor.refresh()
+    else:
+        agent = GeminiAgent(
+            api_key=gemini_key,
+            user_id=user_id,
+            chat_history=storage.get_chat_history(user_id, limit=10)
+        )
+    _AGENTS[user_id] = (agent, gemini_key, time.monotonic() + AGENT_CACHE_TTL)
+    if len(_AGENTS) > AGENT_CACHE_SIZE:
+        evicted, _ = _AGENTS.popitem(last=False)
+        release_workspace(evicted)
+    return agent
+
+
+def _drop_agent(user_id: str):
+    """Forget a user's cached agent along with its executor and /tmp workspace."""
+    _AGENTS.pop(user_id, None)
+    release_workspace(user_id)
+
+
+# Longest SMS reply, in UTF-8 bytes
+SMS_MAX_BYTES = 1500
+
+# Single-pass XML escaping for TwiML bodies
+_XML_ESCAPES = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
+
+
+# The only webhook form fields the handler reads
+_WEBHOOK_FIELDS = frozenset(("From", "To", "Body"))
+
+
+def _form_fields(body: str, keys: frozenset) -> dict:
+    """Decode the first value of each wanted field from a urlencoded form body."""
+    fields = {}
+    for pair in body.split("&"):
+        name, sep, value = pair.partition("=")
+        name = urllib.parse.unquote_plus(name)
+        if sep and name in keys and name not in fields:
+            fields[name] = urllib.parse.unquote_plus(value)
+            if len(fields) == len(keys):
+                break
+    return fields
+
 
 def response(status_code: int, body: str, content_type: str = "application/xml") -> dict:
     """Create API Gateway response for Twilio."""
@@ -29,14 +88,14 @@ def response(status_code: int, body: str, content_type: str = "application/xml")
 
 def twiml_response(message: str) -> str:
     """Create TwiML response for SMS."""
-    # Escape XML special characters
-    message = message.replace("&", "&amp;")
-    message = message.replace("<", "&lt;")
-    message = message.replace(">", "&gt;")
+    # Truncate for SMS limits (1600 chars max for multipart). Capping UTF-8
+    # bytes also caps UTF-16 units, so emoji can't push the message over.
+    encoded = message.encode("utf-8")
+    if len(encoded) > SMS_MAX_BYTES:
+        message = encoded[:SMS_MAX_BYTES - 3].decode("utf-8", "ignore") + "..."
     
-    # Truncate for SMS limits (1600 chars max for multipart)
-    if len(message) > 1500:
-        message = message[:1497] + "..."
+    # Escape XML special characters (after truncating, so no entity is cut)
+    message = message.translate(_XML_ESCAPES)
     
     return f"""<?xml version="1.0" encoding="UTF-8"?>
 <Response>
@@ -60,14 +119,13 @@ def handler(event, context):
     try:
         body = event.get("body", "")
         if event.get("isBase64Encoded"):
-            import base64
             body = base64.b64decode(body).decode("utf-8")
         
-        params = urllib.parse.parse_qs(body)
+        params = _form_fields(body, _WEBHOOK_FIELDS)
         
-        from_number = params.get("From", [""])[0]
-        to_number = params.get("To", [""])[0]
-        message_body = params.get("Body", [""])[0].strip()
+        from_number = params.get("From", "")
+        to_number = params.get("To", "")
+        message_body = params.get("Body", "").strip()
         
     except Exception as e:
         return response(400, twiml_response(f"Error parsing request: {str(e)}"))
@@ -204,6 +262,8 @@ def handle_set_key(user_id: str, message: str):
 
 def handle_clear(user_id: str):
     """Handle CLEAR command."""
+    _drop_agent(user_id)
+    _drop_agent(f"{user_id}@sms.delta3.ai")
     storage.clear_chat_history(user_id)
     return response(200, twiml_response("Chat history cleared!"))
 
@@ -236,25 +296,15 @@ def handle_chat(user_id: str, message: str):
         ))
     
     try:
-        # Load chat history for context
-        chat_history = storage.get_chat_history(user_id, limit=10)
-        
-        # Create agent with persistent environment
-        agent = GeminiAgent(
-            api_key=gemini_key,
-            user_id=user_id,
-            chat_history=chat_history
-        )
+        # Agent with persistent environment and chat history for context
+        agent = _get_agent(user_id, gemini_key)
         result = agent.process_message(message)
         
         # Save to history
-        storage.save_chat_message(user_id, "user", message)
-        storage.save_chat_message(
-            user_id,
-            "assistant",
-            result["response"],
-            tool_calls=result.get("tool_calls")
-        )
+        storage.save_chat_messages(user_id, [
+            {"role": "user", "content": message},
+            {"role": "assistant", "content": result["response"], "tool_calls": result.get("tool_calls")}
+        ])
         
         # Format response for SMS
         response_text = result["response"]
@@ -267,6 +317,7 @@ def handle_chat(user_id: str, message: str):
         return response(200, twiml_response(response_text))
     
     except Exception as e:
+        _drop_agent(user_id)
         error_msg = str(e)
         if "429" in error_msg:
             return response(200, twiml_response(
@@ -15,7 +15,10 @@ import os
 import sys
 import json
 import hashlib
+import hmac
 import secrets
+import tempfile
+import uuid
 from datetime import datetime, timedelta
 from pathlib import Path
 from typing import Optional, Dict, Any, List
@@ -24,6 +27,7 @@ from typing import Optional, Dict, Any, List
 sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
 
 from fastapi import FastAPI, Request, HTTPException, Header
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel
@@ -55,13 +59,26 @@ app.add_middleware(
 
 # ============ Local Storage ============
 
+def write_json_atomic(path: Path, data: Any, indent: Optional[int] = 2):
+    """Write JSON via a temp file + rename so readers never see a partial file."""
+    # A unique temp file per call, so concurrent writers never share one
+    with tempfile.NamedTemporaryFile(
+        "w", dir=path.parent, prefix=f".{path.name}.", suffix=".tmp", delete=False
+    ) as f:
+        f.write(json.dumps(data, indent=indent))
+    try:
+        os.replace(f.name, path)
+    except OSError:
+        os.unlink(f.name)
+        raise
+
 def load_users() -> Dict:
     if USERS_FILE.exists():
         return json.loads(USERS_FILE.read_text())
     return {}
 
 def save_users(users: Dict):
-    USERS_FILE.write_text(json.dumps(users, indent=2))
+    write_json_atomic(USERS_FILE, users)
 
 def load_memories() -> Dict:
     if MEMORIES_FILE.exists():
@@ -69,13 +86,23 @@ def load_memories() -> Dict:
     return {}
 
 def save_memories(memories: Dict):
-    MEMORIES_FILE.write_text(json.dumps(memories, indent=2))
+    write_json_atomic(MEMORIES_FILE, memories)
 
 
 # ============ Auth Helpers ============
 
 def hash_password(password: str) -> str:
-    return hashlib.sha256(password.encode()).hexdigest()
+    salt = secrets.token_bytes(16)
+    digest = hashlib.scrypt(password.encode(), salt=salt, n=2 ** 14, r=8, p=1)
+    return f"scrypt${2 ** 14}$8$1${salt.hex()}${digest.hex()}"
+
+def verify_password(password: str, password_hash: str) -> bool:
+    # Older local data files hold unsalted SHA256 hashes
+    if not password_hash.startswith("scrypt$"):
+        return hmac.compare_digest(password_hash, hashlib.sha256(password.encode()).hexdigest())
+    _, n, r, p, salt, digest = password_hash.split("$")
+    candidate = hashlib.scrypt(password.encode(), salt=bytes.fromhex(salt), n=int(n), r=int(r), p=int(p))
+    return hmac.compare_digest(candidate.hex(), digest)
 
 def generate_api_key() -> str:
     return f"delta3_{secrets.token_hex(24)}"
@@ -169,7 +196,7 @@ async def login(req: LoginRequest):
     user_id = req.email.lower()
     
     user = users.get(user_id)
-    if not user or user["password_hash"] != hash_password(req.password):
+    if not user or not verify_password(req.password, user["password_hash"]):
         raise HTTPException(401, "Invalid credentials")
     
     session_token = generate_session_token()
@@ -244,6 +271,7 @@ async def send_message(
     
     # Load chat history
     chat_file = CHAT_DIR / f"{user_id.replace('@', '_').replace('.', '_')}.json"
+    context_file = chat_file.with_suffix(".context.json")
     chat_history = []
     if chat_file.exists():
         chat_history = json.loads(chat_file.read_text())
@@ -258,7 +286,6 @@ async def send_message(
             if user_id not in memories:
                 memories[user_id] = []
             
-            import uuid
             memory_id = f"{datetime.utcnow().isoformat()}#{uuid.uuid4().hex[:8]}"
             
             memories[user_id].append({
@@ -313,17 +340,24 @@ async def send_message(
     
     # Workspace directory will be created by the executor with "workspace_" prefix
 
+    # Prefer the saved Gemini context (tool turns included) over the text-only chat log
+    saved_context = json.loads(context_file.read_text()) if context_file.exists() else None
+
     agent = GeminiAgent(
         api_key=user["gemini_key"],
         user_id=user_id,
-        chat_history=chat_history[-20:],
+        chat_history=None if saved_context else chat_history[-20:],
         local_mode=True,
         workspace_base=str(FILES_DIR),
         storage_module=LocalStorage()
     )
+    if saved_context:
+        agent.restore_history(saved_context)
     
     try:
-        result = agent.process_message(req.message)
+        # The agent loop blocks on Gemini and subprocesses; keep it off the event loop
+        result = await run_in_threadpool(agent.process_message, req.message)
+        write_json_atomic(context_file, agent.export_history(), indent=None)
         
         # Save to history
         chat_history.append({
@@ -342,7 +376,7 @@ async def send_message(
         if len(chat_history) > 100:
             chat_history = chat_history[-100:]
         
-        chat_file.write_text(json.dumps(chat_history, indent=2))
+        write_json_atomic(chat_file, chat_history)
         
         return {
             "response": result["response"],
@@ -389,6 +423,10 @@ async def clear_history(
     if chat_file.exists():
         chat_file.unlink()
     
+    context_file = chat_file.with_suffix(".context.json")
+    if context_file.exists():
+        context_file.unlink()
+    
     return {"message": "History cleared"}
 
 
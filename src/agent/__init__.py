@@ -4,8 +4,8 @@ DELTA3 AI Agent Module
 This module contains the Gemini-powered AI agent and code execution environment.
 """
 
-from .gemini_agent import GeminiAgent
+from .gemini_agent import GeminiAgent, invalidate_clients
 from .executor import PersistentCodeExecutor
 from .tools import TOOLS, SYSTEM_PROMPT
 
-__all__ = ["GeminiAgent", "PersistentCodeExecutor", "TOOLS", "SYSTEM_PROMPT"]
+__all__ = ["GeminiAgent", "invalidate_clients", "PersistentCodeExecutor", "TOOLS", "SYSTEM_PROMPT"]
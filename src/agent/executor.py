@@ -7,15 +7,41 @@ import os
 import shutil
 import subprocess
 import tempfile
+import threading
 from typing import Dict, Any, Optional
 
 try:
     import boto3
+    from botocore.config import Config
     from botocore.exceptions import ClientError
     HAS_BOTO3 = True
 except ImportError:
     HAS_BOTO3 = False
 
+_s3_client = None
+
+
+def _get_s3_client():
+    """Return the process-wide S3 client, creating it on first use.
+
+    A single client keeps its keep-alive connection pool warm across
+    executors, and the pool is sized so concurrent tool calls don't queue
+    behind botocore's default of 10 connections.
+    """
+    global _s3_client
+    if _s3_client is None:
+        _s3_client = boto3.client(
+            "s3",
+            region_name=os.environ.get("AWS_REGION", "us-east-1"),
+            config=Config(
+                max_pool_connections=32,
+                tcp_keepalive=True,
+                connect_timeout=5,
+                retries={"max_attempts": 3, "mode": "standard"}
+            )
+        )
+    return _s3_client
+
 
 class PersistentCodeExecutor:
     """
@@ -44,14 +70,20 @@ class PersistentCodeExecutor:
         self.s3_prefix = f"users/{user_id}/workspace/"
         
         if HAS_BOTO3 and not local_mode:
-            self.s3 = boto3.client("s3", region_name=os.environ.get("AWS_REGION", "us-east-1"))
+            self.s3 = _get_s3_client()
         else:
             self.s3 = None
         
         self._setup_workspace()
     
     def _setup_workspace(self):
-        """Setup workspace by optionally restoring files from S3."""
+        """Setup workspace and start restoring files from S3 in the background.
+
+        The restore overlaps with the agent's first model call; every
+        workspace operation waits for it via _wait_ready().
+        """
+        self._ready = threading.Event()
+        
         # Clean and create workspace
         if os.path.exists(self.workspace):
             shutil.rmtree(self.workspace)
@@ -59,7 +91,20 @@ class PersistentCodeExecutor:
         
         # Restore files from S3 if available
         if self.s3 and not self.local_mode:
+            threading.Thread(target=self._restore_in_background, daemon=True).start()
+        else:
+            self._ready.set()
+    
+    def _restore_in_background(self):
+        """Restore files from S3 and mark the workspace ready."""
+        try:
             self._restore_from_s3()
+        finally:
+            self._ready.set()
+    
+    def _wait_ready(self):
+        """Block until the initial S3 restore has finished."""
+        self._ready.wait()
     
     def _restore_from_s3(self):
         """Restore files from S3."""
@@ -85,7 +130,9 @@ class PersistentCodeExecutor:
         if path.startswith("/"):
             path = path[1:]
         if path.startswith("tmp/workspace"):
-            path = path.split("/", 3)[-1] if len(path.split("/")) > 3 else ""
+            # tmp/<workspace dir>/<relative path>
+            parts = path.split("/", 2)
+            path = parts[2] if len(parts) > 2 else ""
         
         s3_key = f"{self.s3_prefix}{path}"
         
@@ -121,6 +168,7 @@ class PersistentCodeExecutor:
     
     def execute_python(self, code: str) -> Dict[str, Any]:
         """Execute Python code."""
+        self._wait_ready()
         try:
             with tempfile.NamedTemporaryFile(
                 mode="w", 
@@ -154,6 +202,7 @@ class PersistentCodeExecutor:
     
     def execute_shell(self, command: str) -> Dict[str, Any]:
         """Execute shell command."""
+        self._wait_ready()
         try:
             result = subprocess.run(
                 command,
@@ -176,6 +225,30 @@ class PersistentCodeExecutor:
     
     def write_file(self, path: str, content: str) -> Dict[str, Any]:
         """Write file to workspace and sync to S3."""
+        self._wait_ready()
+        result = self._write_local(path, content)
+        if result["success"]:
+            self._sync_to_s3(result["path"], content)
+        return result
+    
+    def write_and_run(self, path: str, content: str, command: str):
+        """Write a file, then run a shell command while it uploads to S3.
+
+        Returns the (write_file, execute_shell) result pair.
+        """
+        self._wait_ready()
+        write_result = self._write_local(path, content)
+        if not write_result["success"]:
+            return write_result, self.execute_shell(command)
+        
+        sync = threading.Thread(target=self._sync_to_s3, args=(write_result["path"], content))
+        sync.start()
+        run_result = self.execute_shell(command)
+        sync.join()
+        return write_result, run_result
+    
+    def _write_local(self, path: str, content: str) -> Dict[str, Any]:
+        """Write file to the local workspace only."""
         try:
             clean_path = path.lstrip("/")
             full_path = os.path.join(self.workspace, clean_path)
@@ -186,14 +259,13 @@ class PersistentCodeExecutor:
             with open(full_path, "w") as f:
                 f.write(content)
             
-            self._sync_to_s3(clean_path, content)
-            
             return {"success": True, "path": clean_path}
         except Exception as e:
             return {"success": False, "error": str(e)}
     
     def read_file(self, path: str) -> Dict[str, Any]:
         """Read file from workspace."""
+        self._wait_ready()
         try:
             clean_path = path.lstrip("/")
             full_path = os.path.join(self.workspace, clean_path)
@@ -209,6 +281,7 @@ class PersistentCodeExecutor:
     
     def list_files(self, path: str = "") -> Dict[str, Any]:
         """List files in directory."""
+        self._wait_ready()
         try:
             clean_path = path.lstrip("/") if path else ""
             full_path = os.path.join(self.workspace, clean_path) if clean_path else self.workspace
@@ -235,6 +308,7 @@ class PersistentCodeExecutor:
     
     def delete_file(self, path: str) -> Dict[str, Any]:
         """Delete file from workspace and S3."""
+        self._wait_ready()
         try:
             clean_path = path.lstrip("/")
             full_path = os.path.join(self.workspace, clean_path)
@@ -2,13 +2,250 @@
 Gemini AI Agent for code generation and execution.
 """
 
-from typing import Dict, Any, List, Optional
+import contextlib
+import functools
+import hashlib
+import itertools
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional, Tuple
+import httpx
 from google import genai
-from google.genai import types
+from google.genai import errors, types
 
 from .executor import PersistentCodeExecutor
 from .tools import TOOLS, SYSTEM_PROMPT
 
+# Upper bound on tool calls from a single model turn that run concurrently
+MAX_PARALLEL_TOOLS = 8
+
+# Retries for a rate-limited or temporarily unavailable Gemini call
+MAX_RETRIES = 2
+RETRYABLE_STATUS = {429, 503, 504}
+
+# Longest wait before a retry; a Retry-After beyond this fails the call instead
+MAX_RETRY_DELAY = 10.0
+
+# Maximum number of read_file / list_files results memoized per agent
+READ_CACHE_SIZE = 128
+
+# list_files output is capped at this many entries
+MAX_LIST_ENTRIES = 500
+
+# Tool results are clipped to this many bytes before entering the history
+MAX_RESULT_BYTES = 4096
+
+# Number of most recent tool-result turns kept verbatim in the history
+HISTORY_KEEP_TURNS = 2
+
+# read_file keeps this much of MAX_RESULT_BYTES for its own paging header,
+# so a page or head/tail preview is never cut by _clip_result
+READ_HEADER_BYTES = 256
+READ_BUDGET_BYTES = MAX_RESULT_BYTES - READ_HEADER_BYTES
+
+# Number of large file bodies kept for follow-up 'blob:<sha>' reads
+BLOB_CACHE_SIZE = 16
+
+# Process-wide tool limits, shared by every agent (0 disables the rate limit)
+MAX_CONCURRENCY = int(os.environ.get("DELTA3_MAX_CONCURRENCY", "6"))
+MAX_HEAVY_CONCURRENCY = int(os.environ.get("DELTA3_MAX_HEAVY_CONCURRENCY", "2"))
+TOOL_RPS = float(os.environ.get("DELTA3_RPS", "30"))
+
+_EXEC_TOOLS = {"execute_python", "execute_shell"}
+_FILE_READ_TOOLS = {"read_file", "list_files"}
+_FILE_WRITE_TOOLS = {"write_file", "delete_file"}
+_MEMORY_WRITE_TOOLS = {"store_memory", "update_memory", "delete_memory"}
+
+
+class _RateLimiter:
+    """Spaces calls at least 1/rate seconds apart across all threads."""
+    
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next_slot = 0.0
+        self.lock = threading.Lock()
+    
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+_tool_slots = threading.BoundedSemaphore(max(MAX_CONCURRENCY, 1))
+_heavy_slots = threading.BoundedSemaphore(max(MAX_HEAVY_CONCURRENCY, 1))
+_tool_rate = _RateLimiter(TOOL_RPS)
+
+
+@contextlib.contextmanager
+def _tool_slot(name: str):
+    """Hold a process-wide tool slot (and a heavy slot for code execution)."""
+    _tool_rate.wait()
+    with _tool_slots:
+        if name in _EXEC_TOOLS:
+            with _heavy_slots:
+                yield
+        else:
+            yield
+
+
+@functools.lru_cache(maxsize=32)
+def _gemini_client(api_key: str) -> genai.Client:
+    """Shared Gemini client per API key, so agents reuse warm HTTP connections."""
+    return genai.Client(api_key=api_key)
+
+
+def invalidate_clients():
+    """Drop the shared Gemini clients, e.g. after an API key was rejected."""
+    _gemini_client.cache_clear()
+
+
+@functools.lru_cache(maxsize=32)
+def _generate_config(system_instruction: str) -> types.GenerateContentConfig:
+    """Build (once per distinct system prompt) the config sent with every call."""
+    return types.GenerateContentConfig(
+        tools=TOOLS,
+        system_instruction=system_instruction
+    )
+
+
+def _utf8_head(text: str, limit: int) -> str:
+    """Longest prefix of text that fits in limit bytes of UTF-8."""
+    return text.encode("utf-8")[:limit].decode("utf-8", errors="ignore")
+
+
+def _utf8_tail(text: str, limit: int) -> str:
+    """Longest suffix of text that fits in limit bytes of UTF-8."""
+    return text.encode("utf-8")[-limit:].decode("utf-8", errors="ignore")
+
+
+def _clip_result(result: str) -> str:
+    """Clip a tool result to MAX_RESULT_BYTES of UTF-8."""
+    encoded = result.encode("utf-8")
+    if len(encoded) <= MAX_RESULT_BYTES:
+        return result
+    head = encoded[:MAX_RESULT_BYTES].decode("utf-8", errors="ignore")
+    return f"{head}\n...[truncated {len(encoded) - MAX_RESULT_BYTES} bytes]"
+
+
+def _preview_args(args: Dict, limit: int = 100) -> Dict:
+    """Copy tool args for display, clipping long string values."""
+    return {
+        key: value[:limit] + "..." if isinstance(value, str) and len(value) > limit else value
+        for key, value in args.items()
+    }
+
+
+def _elide_result(result: str) -> str:
+    """Replace an old tool result with a short size + hash placeholder."""
+    digest = hashlib.sha1(result.encode("utf-8")).hexdigest()[:8]
+    return f"[elided {len(result)} bytes, sha1={digest}]"
+
+
+def _retry_delay(error: Optional[errors.APIError], attempt: int) -> float:
+    """Seconds to wait before retrying, honoring the server's Retry-After."""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return max(float(headers.get("retry-after")), 0.0)
+    except (TypeError, ValueError):
+        return min(2 ** attempt + random.random(), MAX_RETRY_DELAY)
+
+
+def _is_text_part(part: Dict) -> bool:
+    return "text" in part and "function_call" not in part
+
+
+def _merge_text_parts(parts: List[Dict]) -> List[Dict]:
+    """Join adjacent streamed text fragments back into single text parts."""
+    merged = []
+    for part in parts:
+        if _is_text_part(part) and merged and _is_text_part(merged[-1]):
+            merged[-1] = {**merged[-1], "text": merged[-1]["text"] + part["text"]}
+        else:
+            merged.append(part)
+    return merged
+
+
+def _format_shell(result: Dict[str, Any]) -> str:
+    """Format an execute_shell result for the model."""
+    output = ""
+    if result["stdout"]:
+        output += result["stdout"]
+    if result["stderr"]:
+        output += f"\nErrors:\n{result['stderr']}"
+    if not output:
+        output = f"Command completed (exit code: {result['exit_code']})"
+    return output
+
+
+def _format_write(result: Dict[str, Any]) -> str:
+    """Format a write_file result for the model."""
+    if result["success"]:
+        return f"✅ File saved: {result['path']} (persisted to storage)"
+    return f"❌ Error: {result['error']}"
+
+
+def _runs_written_file(write_call: Tuple[str, Dict], call: Tuple[str, Dict]) -> bool:
+    """Return True if call is an execute_shell that just runs the file write_call wrote."""
+    name, args = call
+    if write_call[0] != "write_file" or name != "execute_shell":
+        return False
+    words = args.get("command", "").split()
+    return (
+        len(words) == 2
+        and words[0] in ("python", "python3")
+        and os.path.normpath(words[1].lstrip("/"))
+        == os.path.normpath(write_call[1].get("path", "").lstrip("/"))
+    )
+
+
+def _paths_overlap(a: str, b: str) -> bool:
+    """Return True if one workspace path is equal to or contains the other."""
+    a, b = a.strip("/"), b.strip("/")
+    if not a or not b or a == b:
+        return True
+    return a.startswith(b + "/") or b.startswith(a + "/")
+
+
+def _must_serialize(calls: List[Tuple[str, Dict]]) -> bool:
+    """Return True if a turn's tool calls have to run one after another.
+
+    Code execution can touch any file, so it is never overlapped with other
+    workspace tools. File tools only conflict when a write or delete shares a
+    path with another call, and memory writes are kept ordered because the
+    storage backends do read-modify-write.
+    """
+    names = [name for name, _ in calls]
+    file_calls = [
+        (name, args.get("path", ""))
+        for name, args in calls
+        if name in _FILE_READ_TOOLS or name in _FILE_WRITE_TOOLS
+    ]
+
+    exec_count = sum(name in _EXEC_TOOLS for name in names)
+    if exec_count and exec_count + len(file_calls) > 1:
+        return True
+
+    if sum(name in _MEMORY_WRITE_TOOLS for name in names) > 1:
+        return True
+
+    for i, (name, path) in enumerate(file_calls):
+        for other_name, other_path in file_calls[i + 1:]:
+            if (name in _FILE_WRITE_TOOLS or other_name in _FILE_WRITE_TOOLS) and \
+                    _paths_overlap(path, other_path):
+                return True
+
+    return False
+
 
 class GeminiAgent:
     """Gemini-powered coding agent with persistent environment."""
@@ -33,7 +270,7 @@ class GeminiAgent:
             workspace_base: Base directory for workspace
             storage_module: Storage module for memories (optional)
         """
-        self.client = genai.Client(api_key=api_key)
+        self.client = _gemini_client(api_key)
         self.user_id = user_id
         self.local_mode = local_mode
         self.storage = storage_module
@@ -44,7 +281,12 @@ class GeminiAgent:
             local_mode=local_mode
         )
         
-        self.history: List[types.Content] = []
+        # Plain ContentDicts: the SDK accepts them as-is and they are JSON-safe
+        self.history: List[Dict] = []
+        
+        self._read_cache: "OrderedDict[Tuple, str]" = OrderedDict()
+        self._read_cache_lock = threading.Lock()
+        self._blob_cache: "OrderedDict[str, str]" = OrderedDict()
         
         if chat_history:
             self._load_history(chat_history)
@@ -58,22 +300,14 @@ class GeminiAgent:
             content = msg.get("content", "")
 
             if role == "user":
-                self.history.append(types.Content(
-                    role="user",
-                    parts=[types.Part.from_text(text=content)]
-                ))
+                self.history.append({"role": "user", "parts": [{"text": content}]})
             elif role == "assistant":
-                self.history.append(types.Content(
-                    role="model",
-                    parts=[types.Part.from_text(text=content)]
-                ))
+                self.history.append({"role": "model", "parts": [{"text": content}]})
 
     def _load_memories(self) -> str:
         """Load relevant memories and format for context injection."""
         if not self.storage:
             return ""
-        
-        from datetime import datetime, timedelta
 
         memories = []
 
@@ -133,7 +367,43 @@ class GeminiAgent:
         return "\n".join(context_parts)
     
     def execute_tool(self, name: str, args: Dict) -> str:
-        """Execute a tool and return result as string."""
+        """Execute a tool and return result as string.
+
+        Results of read-only file tools are memoized until a write, delete
+        or code execution could have changed the workspace.
+        """
+        if name in _FILE_READ_TOOLS:
+            key = (name, args.get("path", "").strip("/"), args.get("offset"), args.get("length"))
+            with self._read_cache_lock:
+                if key in self._read_cache:
+                    self._read_cache.move_to_end(key)
+                    return self._read_cache[key]
+            
+            with _tool_slot(name):
+                result = self._run_tool(name, args)
+            if not result.startswith("❌"):
+                with self._read_cache_lock:
+                    self._read_cache[key] = result
+                    if len(self._read_cache) > READ_CACHE_SIZE:
+                        self._read_cache.popitem(last=False)
+            return result
+        
+        with _tool_slot(name):
+            result = self._run_tool(name, args)
+        
+        if name in _EXEC_TOOLS:
+            with self._read_cache_lock:
+                self._read_cache.clear()
+        elif name in _FILE_WRITE_TOOLS:
+            path = args.get("path", "")
+            with self._read_cache_lock:
+                for key in [k for k in self._read_cache if _paths_overlap(k[1], path)]:
+                    del self._read_cache[key]
+        
+        return result
+    
+    def _run_tool(self, name: str, args: Dict) -> str:
+        """Run a tool without consulting the read cache."""
         
         # Code execution tools
         if name == "execute_python":
@@ -148,39 +418,28 @@ class GeminiAgent:
             return output
         
         elif name == "execute_shell":
-            result = self.executor.execute_shell(args["command"])
-            output = ""
-            if result["stdout"]:
-                output += result["stdout"]
-            if result["stderr"]:
-                output += f"\nErrors:\n{result['stderr']}"
-            if not output:
-                output = f"Command completed (exit code: {result['exit_code']})"
-            return output
+            return _format_shell(self.executor.execute_shell(args["command"]))
         
         # File tools
         elif name == "write_file":
-            result = self.executor.write_file(args["path"], args["content"])
-            if result["success"]:
-                return f"✅ File saved: {result['path']} (persisted to storage)"
-            return f"❌ Error: {result['error']}"
+            return _format_write(self.executor.write_file(args["path"], args["content"]))
         
         elif name == "read_file":
-            result = self.executor.read_file(args["path"])
-            if result["success"]:
-                return result["content"]
-            return f"❌ Error: {result['error']}"
+            return self._read_file(args)
         
         elif name == "list_files":
             result = self.executor.list_files(args.get("path", ""))
             if result["success"]:
                 if not result["files"]:
                     return "📁 Directory is empty (no files yet)"
-                return "Files in workspace:\n" + "\n".join(
-                    f"{'📁' if f['type'] == 'directory' else '📄'} {f['name']}"
-                    + (f" ({f['size']} bytes)" if f.get('size') else "")
-                    for f in result["files"]
-                )
+                files = result["files"]
+                lines = [
+                    f"{f['name']}/" if f["type"] == "directory" else f["name"]
+                    for f in files[:MAX_LIST_ENTRIES]
+                ]
+                if len(files) > MAX_LIST_ENTRIES:
+                    lines.append(f"...[{len(files) - MAX_LIST_ENTRIES} more truncated]")
+                return "Files in workspace:\n" + "\n".join(lines)
             return f"❌ Error: {result['error']}"
         
         elif name == "delete_file":
@@ -272,13 +531,175 @@ class GeminiAgent:
 
         return f"Unknown tool: {name}"
     
+    def _read_file(self, args: Dict) -> str:
+        """Read a file or cached blob, paging anything that won't fit in one tool result."""
+        path = args["path"]
+        if path.startswith("blob:"):
+            with self._read_cache_lock:
+                content = self._blob_cache.get(path[5:])
+            if content is None:
+                return f"❌ Error: Unknown or expired blob: {path[5:]}"
+        else:
+            result = self.executor.read_file(path)
+            if not result["success"]:
+                return f"❌ Error: {result['error']}"
+            content = result["content"]
+        
+        full = content
+        paged = args.get("offset") is not None or args.get("length") is not None
+        start = 0
+        if paged:
+            start = int(args.get("offset") or 0)
+            end = start + int(args["length"]) if args.get("length") is not None else None
+            content = full[start:end]
+        
+        if len(content.encode("utf-8")) <= MAX_RESULT_BYTES:
+            return content
+        
+        sha = hashlib.sha1(full.encode("utf-8", errors="replace")).hexdigest()[:12]
+        with self._read_cache_lock:
+            self._blob_cache[sha] = full
+            self._blob_cache.move_to_end(sha)
+            if len(self._blob_cache) > BLOB_CACHE_SIZE:
+                self._blob_cache.popitem(last=False)
+        
+        if paged:
+            page = _utf8_head(content, READ_BUDGET_BYTES)
+            next_offset = start + len(page)
+            return (
+                f"[chars {start}-{next_offset} of {len(full)}, sha={sha}; "
+                f"read 'blob:{sha}' with offset={next_offset} for more]\n{page}"
+            )
+        return (
+            f"[large file {len(full)} chars, sha={sha}; read 'blob:{sha}' with offset/length for more]\n"
+            f"--head--\n{_utf8_head(content, READ_BUDGET_BYTES // 2)}\n"
+            f"--tail--\n{_utf8_tail(content, READ_BUDGET_BYTES // 2)}"
+        )
+    
+    def _compact_history(self):
+        """Elide tool results older than the last HISTORY_KEEP_TURNS turns."""
+        tool_turns = [
+            i for i, content in enumerate(self.history)
+            if any("function_response" in part for part in content["parts"])
+        ]
+        stale = tool_turns[:max(len(tool_turns) - HISTORY_KEEP_TURNS, 0)]
+        
+        for i in stale:
+            content = self.history[i]
+            parts = []
+            for part in content["parts"]:
+                fr = part.get("function_response")
+                result = (fr.get("response") or {}).get("result", "") if fr else ""
+                if fr and not result.startswith("[elided "):
+                    part = {"function_response": {
+                        "name": fr["name"],
+                        "response": {"result": _elide_result(result)}
+                    }}
+                parts.append(part)
+            self.history[i] = {"role": content["role"], "parts": parts}
+    
+    def _write_and_run(self, write_args: Dict, run_args: Dict) -> Tuple[str, str]:
+        """Run a write_file + execute_shell pair, overlapping the S3 upload with the run."""
+        with _tool_slot("execute_shell"):
+            write_result, run_result = self.executor.write_and_run(
+                write_args["path"], write_args["content"], run_args["command"]
+            )
+        with self._read_cache_lock:
+            self._read_cache.clear()
+        return _format_write(write_result), _format_shell(run_result)
+    
+    def _open_stream(self, config: types.GenerateContentConfig):
+        """Start a streamed generate_content call, retrying transient failures.
+
+        The request is only sent once the stream is iterated, so the first
+        chunk is pulled here and chained back in front of the rest.
+        """
+        for attempt in range(MAX_RETRIES + 1):
+            stream = self.client.models.generate_content_stream(
+                model="gemini-2.0-flash",
+                contents=self.history,
+                config=config
+            )
+            try:
+                first = next(stream, None)
+            except errors.APIError as e:
+                if e.code not in RETRYABLE_STATUS or attempt == MAX_RETRIES:
+                    raise
+                delay = _retry_delay(e, attempt)
+                # Waiting out a long Retry-After would stall the request and its worker
+                if delay > MAX_RETRY_DELAY:
+                    raise
+            except httpx.TimeoutException:
+                if attempt == MAX_RETRIES:
+                    raise
+                delay = _retry_delay(None, attempt)
+            else:
+                return itertools.chain([first] if first is not None else [], stream)
+            time.sleep(delay)
+    
+    def _stream_turn(
+        self, config: types.GenerateContentConfig
+    ) -> Tuple[List[Dict], List[Tuple[str, Dict]], List[str]]:
+        """Stream one model turn, starting each tool call as soon as it arrives.
+
+        Returns the turn's parts, its tool calls and their results in call
+        order. A call that conflicts with calls already started waits for
+        them to finish first, so the model's ordering is preserved.
+        """
+        parts = []
+        calls = []
+        futures = []
+        held_write = None
+        
+        with ThreadPoolExecutor(max_workers=MAX_PARALLEL_TOOLS) as pool:
+            def submit(new_calls, fn, *fn_args):
+                if calls and _must_serialize(calls + new_calls):
+                    for future, _ in futures:
+                        future.result()
+                future = pool.submit(fn, *fn_args)
+                for i, call in enumerate(new_calls):
+                    calls.append(call)
+                    futures.append((future, i if len(new_calls) > 1 else None))
+            
+            for chunk in self._open_stream(config):
+                if not chunk.candidates or not chunk.candidates[0].content:
+                    continue
+                for part in chunk.candidates[0].content.parts or []:
+                    parts.append(part.model_dump(mode="json", exclude_none=True))
+                    if not part.function_call:
+                        continue
+                    
+                    fc = part.function_call
+                    call = (fc.name, dict(fc.args) if fc.args else {})
+                    
+                    # Hold a write until the next call, in case it runs the file
+                    if held_write and _runs_written_file(held_write, call):
+                        submit([held_write, call], self._write_and_run, held_write[1], call[1])
+                        held_write = None
+                        continue
+                    if held_write:
+                        submit([held_write], self.execute_tool, *held_write)
+                        held_write = None
+                    
+                    if call[0] == "write_file":
+                        held_write = call
+                    else:
+                        submit([call], self.execute_tool, *call)
+            
+            if held_write:
+                submit([held_write], self.execute_tool, *held_write)
+            
+            results = [
+                future.result() if i is None else future.result()[i]
+                for future, i in futures
+            ]
+        
+        return _merge_text_parts(parts), calls, results
+    
     def process_message(self, user_message: str) -> Dict[str, Any]:
         """Process user message and return response with tool calls."""
         # Add user message to history
-        self.history.append(types.Content(
-            role="user",
-            parts=[types.Part.from_text(text=user_message)]
-        ))
+        self.history.append({"role": "user", "parts": [{"text": user_message}]})
 
         tool_calls = []
         max_iterations = 10
@@ -289,72 +710,75 @@ class GeminiAgent:
         enhanced_prompt = SYSTEM_PROMPT
         if memory_context:
             enhanced_prompt += f"\n\n{memory_context}"
+        config = _generate_config(enhanced_prompt)
 
         for _ in range(max_iterations):
+            self._compact_history()
+            
             try:
-                response = self.client.models.generate_content(
-                    model="gemini-2.0-flash",
-                    contents=self.history,
-                    config=types.GenerateContentConfig(
-                        tools=TOOLS,
-                        system_instruction=enhanced_prompt
-                    )
-                )
+                parts, calls, results = self._stream_turn(config)
             except Exception as e:
+                if isinstance(e, errors.APIError) and e.code in (401, 403):
+                    invalidate_clients()
                 return {
                     "response": f"Error calling Gemini: {str(e)}",
                     "tool_calls": tool_calls
                 }
             
-            if not response.candidates or not response.candidates[0].content.parts:
+            if not parts:
                 return {
                     "response": final_text if final_text else "No response generated",
                     "tool_calls": tool_calls
                 }
             
-            self.history.append(response.candidates[0].content)
-            
-            has_tool_calls = False
-            tool_response_parts = []
+            self.history.append({"role": "model", "parts": parts})
             
-            for part in response.candidates[0].content.parts:
-                if part.function_call:
-                    has_tool_calls = True
-                    fc = part.function_call
-                    args = dict(fc.args) if fc.args else {}
-                    
-                    result = self.execute_tool(fc.name, args)
-                    
-                    tool_calls.append({
-                        "tool": fc.name,
-                        "args": args,
-                        "result": result[:500]
-                    })
-                    
-                    tool_response_parts.append(types.Part.from_function_response(
-                        name=fc.name,
-                        response={"result": result}
-                    ))
-                
-                elif part.text:
-                    final_text = part.text
+            for part in parts:
+                if _is_text_part(part) and part["text"]:
+                    final_text = part["text"]
             
-            if not has_tool_calls:
+            if not calls:
                 return {
                     "response": final_text,
                     "tool_calls": tool_calls
                 }
             
-            self.history.append(types.Content(
-                role="user",
-                parts=tool_response_parts
-            ))
+            tool_response_parts = []
+            for (name, args), result in zip(calls, results):
+                tool_calls.append({
+                    "tool": name,
+                    "args": _preview_args(args),
+                    "result": result[:500]
+                })
+                
+                tool_response_parts.append({"function_response": {
+                    "name": name,
+                    "response": {"result": _clip_result(result)}
+                }})
+            
+            self.history.append({"role": "user", "parts": tool_response_parts})
         
         return {
             "response": final_text if final_text else "Completed with tool calls",
             "tool_calls": tool_calls
         }
     
+    def export_history(self) -> List[Dict]:
+        """Return the full Gemini context (including tool turns) as JSON-safe dicts."""
+        return list(self.history)
+    
+    def restore_history(self, contents: List[Dict], max_contents: int = 40):
+        """Replace the context with one saved by export_history()."""
+        history = list(contents[-max_contents:])
+        
+        # Start on a user text turn so no tool response loses its call
+        while history and not (
+            history[0]["role"] == "user" and any("text" in p for p in history[0]["parts"])
+        ):
+            history.pop(0)
+        
+        self.history = history
+    
     def clear_history(self):
         """Clear conversation history."""
         self.history = []
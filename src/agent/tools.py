@@ -56,13 +56,21 @@ TOOLS = [
             ),
             types.FunctionDeclaration(
                 name="read_file",
-                description="Read content from a file.",
+                description="Read content from a file. Large files return a head/tail preview with a sha; read 'blob:<sha>' with offset/length to page through them.",
                 parameters=types.Schema(
                     type=types.Type.OBJECT,
                     properties={
                         "path": types.Schema(
                             type=types.Type.STRING,
-                            description="File path to read"
+                            description="File path to read, or 'blob:<sha>' from a previous preview"
+                        ),
+                        "offset": types.Schema(
+                            type=types.Type.INTEGER,
+                            description="Character offset to start reading at (default: 0)"
+                        ),
+                        "length": types.Schema(
+                            type=types.Type.INTEGER,
+                            description="Number of characters to read (default: to end of file)"
                         )
                     },
                     required=["path"]
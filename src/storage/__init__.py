@@ -12,6 +12,7 @@ from .users import (
     get_user,
     update_gemini_key,
     hash_password,
+    verify_password,
     generate_api_key,
     generate_session_token
 )
@@ -41,7 +42,7 @@ from .memories import (
 __all__ = [
     # Users
     "create_user", "verify_login", "verify_session", "verify_api_key",
-    "get_user", "update_gemini_key", "hash_password", "generate_api_key",
+    "get_user", "update_gemini_key", "hash_password", "verify_password", "generate_api_key",
     "generate_session_token",
     # Files
     "write_file", "read_file", "list_files", "delete_file", "get_user_prefix",
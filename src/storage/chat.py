@@ -2,6 +2,8 @@
 Chat history storage in S3.
 """
 
+import collections
+import gzip
 import os
 import json
 from datetime import datetime
@@ -10,26 +12,47 @@ from typing import List, Dict, Any
 import boto3
 from botocore.exceptions import ClientError
 
+try:
+    import ijson
+    HAS_IJSON = True
+except ImportError:
+    HAS_IJSON = False
+
 from .files import get_user_prefix
 
 # Configuration
 FILES_BUCKET = os.environ.get("FILES_BUCKET", "delta3-files")
 AWS_REGION = os.environ.get("AWS_REGION", "us-east-1")
 
+# History is stored gzipped; the plain JSON key is still read for older users
+HISTORY_KEY = "chat_history.json.gz"
+LEGACY_HISTORY_KEY = "chat_history.json"
+
 # Client
 s3 = boto3.client("s3", region_name=AWS_REGION)
 
 
+def _open_history(user_id: str):
+    """Open the stored history as a JSON stream; the flag marks the legacy plain key."""
+    prefix = get_user_prefix(user_id)
+    try:
+        response = s3.get_object(Bucket=FILES_BUCKET, Key=f"{prefix}{HISTORY_KEY}")
+        return gzip.GzipFile(fileobj=response["Body"]), False
+    except ClientError:
+        response = s3.get_object(Bucket=FILES_BUCKET, Key=f"{prefix}{LEGACY_HISTORY_KEY}")
+        return response["Body"], True
+
+
 def save_chat_message(user_id: str, role: str, content: str, tool_calls: List = None):
     """Save chat message to history."""
-    key = f"{get_user_prefix(user_id)}chat_history.json"
+    prefix = get_user_prefix(user_id)
     
     # Load existing
     try:
-        response = s3.get_object(Bucket=FILES_BUCKET, Key=key)
-        history = json.loads(response["Body"].read().decode("utf-8"))
+        body, legacy = _open_history(user_id)
+        history = json.loads(body.read().decode("utf-8"))
     except ClientError:
-        history = []
+        history, legacy = [], False
     
     # Append message
     message = {
@@ -49,19 +72,25 @@ def save_chat_message(user_id: str, role: str, content: str, tool_calls: List =
     # Save
     s3.put_object(
         Bucket=FILES_BUCKET,
-        Key=key,
-        Body=json.dumps(history).encode("utf-8"),
-        ContentType="application/json"
+        Key=f"{prefix}{HISTORY_KEY}",
+        Body=gzip.compress(json.dumps(history).encode("utf-8")),
+        ContentType="application/json",
+        ContentEncoding="gzip"
     )
+    if legacy:
+        s3.delete_object(Bucket=FILES_BUCKET, Key=f"{prefix}{LEGACY_HISTORY_KEY}")
 
 
 def get_chat_history(user_id: str, limit: int = 20) -> List[Dict[str, Any]]:
     """Get recent chat history."""
-    key = f"{get_user_prefix(user_id)}chat_history.json"
-    
     try:
-        response = s3.get_object(Bucket=FILES_BUCKET, Key=key)
-        history = json.loads(response["Body"].read().decode("utf-8"))
+        body, _ = _open_history(user_id)
+        if HAS_IJSON:
+            # Stream the array, holding only the last `limit` messages in memory
+            return list(collections.deque(
+                ijson.items(body, "item", use_float=True), maxlen=limit
+            ))
+        history = json.loads(body.read().decode("utf-8"))
         return history[-limit:]
     except ClientError:
         return []
@@ -69,10 +98,16 @@ def get_chat_history(user_id: str, limit: int = 20) -> List[Dict[str, Any]]:
 
 def clear_chat_history(user_id: str) -> bool:
     """Clear chat history."""
-    key = f"{get_user_prefix(user_id)}chat_history.json"
+    prefix = get_user_prefix(user_id)
 
     try:
-        s3.delete_object(Bucket=FILES_BUCKET, Key=key)
+        s3.delete_objects(
+            Bucket=FILES_BUCKET,
+            Delete={"Objects": [
+                {"Key": f"{prefix}{HISTORY_KEY}"},
+                {"Key": f"{prefix}{LEGACY_HISTORY_KEY}"}
+            ], "Quiet": True}
+        )
         return True
     except ClientError:
         return False
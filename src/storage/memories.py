@@ -2,9 +2,12 @@
 Long-term memory storage in DynamoDB.
 """
 
+import itertools
 import os
+import time
 import uuid
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from typing import Optional, List, Dict, Any
 
 import boto3
@@ -18,6 +21,23 @@ AWS_REGION = os.environ.get("AWS_REGION", "us-east-1")
 dynamodb = boto3.resource("dynamodb", region_name=AWS_REGION)
 memories_table = dynamodb.Table(MEMORIES_TABLE)
 
+# Best-effort access-stat writes, kept off the memory read path
+_stats_pool = ThreadPoolExecutor(max_workers=1)
+
+# (epoch second, formatted timestamp) for the most recent now_iso() call
+_clock = [0, ""]
+
+# Per-process sequence that keeps same-second memory_ids in creation order
+_memory_seq = itertools.count()
+
+
+def now_iso() -> str:
+    """UTC timestamp to the second, formatted once per second."""
+    t = int(time.time())
+    if t != _clock[0]:
+        _clock[:] = [t, datetime.fromtimestamp(t, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")]
+    return _clock[1]
+
 
 def save_memory(
     user_id: str,
@@ -28,8 +48,8 @@ def save_memory(
     source_context: str = None
 ) -> Dict[str, Any]:
     """Save a new memory."""
-    timestamp = datetime.utcnow().isoformat() + 'Z'
-    memory_id = f"{timestamp}#{uuid.uuid4().hex[:8]}"
+    timestamp = now_iso()
+    memory_id = f"{timestamp}#{next(_memory_seq):06d}{uuid.uuid4().hex[:8]}"
 
     item = {
         "user_id": user_id,
@@ -89,9 +109,8 @@ def get_memories(
         if tags:
             memories = [m for m in memories if any(t in m.get("tags", []) for t in tags)]
 
-        # Update access stats for top 10 memories
-        for memory in memories[:10]:
-            _increment_access_count(user_id, memory["memory_id"])
+        # Update access stats for top 10 memories off the request path
+        _stats_pool.submit(_increment_access_counts, user_id, [m["memory_id"] for m in memories[:10]])
 
         return memories
 
@@ -126,7 +145,7 @@ def update_memory(
     """Update an existing memory."""
     try:
         update_expr = "SET last_accessed = :now"
-        expr_values = {":now": datetime.utcnow().isoformat() + 'Z'}
+        expr_values = {":now": now_iso()}
 
         if new_content:
             update_expr += ", content = :content"
@@ -158,16 +177,22 @@ def delete_memory(user_id: str, memory_id: str) -> bool:
         return False
 
 
-def _increment_access_count(user_id: str, memory_id: str):
-    """Increment access count for a memory."""
+def _increment_access_counts(user_id: str, memory_ids: list):
+    """Increment access counts for several memories in one transactional write."""
+    if not memory_ids:
+        return
+    now = now_iso()
     try:
-        memories_table.update_item(
-            Key={"user_id": user_id, "memory_id": memory_id},
-            UpdateExpression="SET access_count = access_count + :inc, last_accessed = :now",
-            ExpressionAttributeValues={
-                ":inc": 1,
-                ":now": datetime.utcnow().isoformat() + 'Z'
+        memories_table.meta.client.transact_write_items(TransactItems=[
+            {
+                "Update": {
+                    "TableName": MEMORIES_TABLE,
+                    "Key": {"user_id": {"S": user_id}, "memory_id": {"S": memory_id}},
+                    "UpdateExpression": "SET access_count = access_count + :inc, last_accessed = :now",
+                    "ExpressionAttributeValues": {":inc": {"N": "1"}, ":now": {"S": now}}
+                }
             }
-        )
+            for memory_id in memory_ids
+        ])
     except ClientError:
         pass  # Non-critical, fail silently
@@ -4,8 +4,9 @@ User management and authentication.
 
 import os
 import hashlib
+import hmac
 import secrets
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from typing import Optional, Dict, Any
 
 import boto3
@@ -13,16 +14,35 @@ from botocore.exceptions import ClientError
 
 # Configuration
 USERS_TABLE = os.environ.get("USERS_TABLE", "delta3-users")
+SESSIONS_TABLE = os.environ.get("SESSIONS_TABLE", "delta3-sessions")
 AWS_REGION = os.environ.get("AWS_REGION", "us-east-1")
 
 # Clients
 dynamodb = boto3.resource("dynamodb", region_name=AWS_REGION)
 users_table = dynamodb.Table(USERS_TABLE)
+sessions_table = dynamodb.Table(SESSIONS_TABLE)
+
+
+# scrypt cost parameters (16 MB of memory per hash)
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
 
 
 def hash_password(password: str) -> str:
-    """Hash password with SHA256."""
-    return hashlib.sha256(password.encode()).hexdigest()
+    """Hash password with salted scrypt."""
+    salt = secrets.token_bytes(16)
+    digest = hashlib.scrypt(password.encode(), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P)
+    return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${digest.hex()}"
+
+
+def verify_password(password: str, password_hash: str) -> bool:
+    """Check a password against a stored scrypt hash (or a legacy unsalted SHA256 one)."""
+    if not password_hash.startswith("scrypt$"):
+        return hmac.compare_digest(password_hash, hashlib.sha256(password.encode()).hexdigest())
+    _, n, r, p, salt, digest = password_hash.split("$")
+    candidate = hashlib.scrypt(password.encode(), salt=bytes.fromhex(salt), n=int(n), r=int(r), p=int(p))
+    return hmac.compare_digest(candidate.hex(), digest)
 
 
 def generate_api_key() -> str:
@@ -39,14 +59,6 @@ def create_user(email: str, password: str) -> Dict[str, Any]:
     """Create a new user account."""
     user_id = email.lower()
     
-    # Check if exists
-    try:
-        response = users_table.get_item(Key={"user_id": user_id})
-        if "Item" in response:
-            raise ValueError("User already exists")
-    except ClientError:
-        pass
-    
     api_key = generate_api_key()
     
     user = {
@@ -56,11 +68,16 @@ def create_user(email: str, password: str) -> Dict[str, Any]:
         "api_key": api_key,
         "gemini_key": None,
         "created_at": datetime.utcnow().isoformat(),
-        "last_login": None,
-        "sessions": {}
+        "last_login": None
     }
     
-    users_table.put_item(Item=user)
+    # Conditional put: DynamoDB rejects an existing user atomically, in one round-trip
+    try:
+        users_table.put_item(Item=user, ConditionExpression="attribute_not_exists(user_id)")
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            raise ValueError("User already exists")
+        raise
     return {"user_id": user_id, "api_key": api_key}
 
 
@@ -74,22 +91,31 @@ def verify_login(email: str, password: str) -> Optional[Dict[str, Any]]:
             return None
         
         user = response["Item"]
-        if user["password_hash"] != hash_password(password):
+        if not verify_password(password, user["password_hash"]):
             return None
         
-        # Create session
+        # Create session, one row per token; DynamoDB TTL removes expired rows
         session_token = generate_session_token()
-        expires = (datetime.utcnow() + timedelta(days=7)).isoformat()
+        now = datetime.utcnow()
+        expires_at = now + timedelta(days=7)
+        expires = expires_at.isoformat()
         
-        # Update user with new session
+        sessions_table.put_item(Item={
+            "session_token": session_token,
+            "user_id": user_id,
+            "expires": expires,
+            "ttl": int(expires_at.replace(tzinfo=timezone.utc).timestamp())
+        })
+        update = "SET last_login = :now"
+        values = {":now": now.isoformat()}
+        # Upgrade a legacy SHA256 hash while the plaintext is at hand
+        if not user["password_hash"].startswith("scrypt$"):
+            update += ", password_hash = :hash"
+            values[":hash"] = hash_password(password)
         users_table.update_item(
             Key={"user_id": user_id},
-            UpdateExpression="SET last_login = :now, sessions.#token = :expires",
-            ExpressionAttributeNames={"#token": session_token},
-            ExpressionAttributeValues={
-                ":now": datetime.utcnow().isoformat(),
-                ":expires": expires
-            }
+            UpdateExpression=update,
+            ExpressionAttributeValues=values
         )
         
         return {
@@ -106,36 +132,53 @@ def verify_login(email: str, password: str) -> Optional[Dict[str, Any]]:
 def verify_session(session_token: str) -> Optional[str]:
     """Verify session token and return user_id."""
     try:
-        response = users_table.scan(
-            FilterExpression="attribute_exists(sessions.#token)",
-            ExpressionAttributeNames={"#token": session_token}
-        )
-        
-        if not response.get("Items"):
-            return None
+        response = sessions_table.get_item(Key={"session_token": session_token})
+        session = response.get("Item")
         
-        user = response["Items"][0]
-        expires = user.get("sessions", {}).get(session_token)
-        
-        if expires and datetime.fromisoformat(expires) > datetime.utcnow():
-            return user["user_id"]
+        # TTL deletion lags behind expiry, so the timestamp is still checked
+        if session and datetime.fromisoformat(session["expires"]) > datetime.utcnow():
+            return session["user_id"]
         
         return None
     except (ClientError, ValueError):
         return None
 
 
+def _scan_for_api_key(api_key: str) -> Optional[Dict[str, Any]]:
+    """Find an API key's user with a full scan, while ApiKeyIndex is missing or backfilling."""
+    kwargs = {
+        "FilterExpression": "api_key = :key",
+        "ExpressionAttributeValues": {":key": api_key}
+    }
+    while True:
+        response = users_table.scan(**kwargs)
+        if response.get("Items"):
+            return response["Items"][0]
+        if "LastEvaluatedKey" not in response:
+            return None
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
 def verify_api_key(api_key: str) -> Optional[str]:
     """Verify API key and return user_id."""
     try:
-        response = users_table.scan(
-            FilterExpression="api_key = :key",
-            ExpressionAttributeValues={":key": api_key}
+        response = users_table.query(
+            IndexName="ApiKeyIndex",
+            KeyConditionExpression="api_key = :key",
+            ExpressionAttributeValues={":key": api_key},
+            Limit=1
         )
         
         if response.get("Items"):
             return response["Items"][0]["user_id"]
         return None
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ValidationException":
+            return None
+    
+    try:
+        user = _scan_for_api_key(api_key)
+        return user["user_id"] if user else None
     except ClientError:
         return None
 